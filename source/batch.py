@@ -0,0 +1,252 @@
+import argparse
+import os
+import time
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import cv2
+from models import configureModels, DEFAULT_PREDICTOR68_PATH, DEFAULT_PREDICTOR81_PATH
+from detection import pyramidScales, reductionForFaceSize, requiredModels, LANDMARK_MODES
+from tiers import TIER_NAMES, tierPipelineOptions, tierReduction
+from pipeline import FacePipeline
+from cache import LandmarkCache, CachedPipeline
+from export import DatasetWriter
+from extractor import face_parts_imgs
+from io_pipeline import iterImagePaths, writeFeatures, encodeParameters, StagedPipeline
+from profiling import getProfiler, enableProfiling
+
+
+# Pipeline of the current worker process (each worker holds its own loaded models)
+_workerPipeline = None
+
+def initWorker(predictor68Path, predictor81Path, pipelineOptions, cacheFolder=None, cacheMaxBytes=None, profile=False):
+    # Function to load the dlib models once per worker process
+    # pipelineOptions: keyword arguments of FacePipeline
+    # cacheFolder: LandmarkCache folder (results of images seen before are re-used)
+    # profile: time the stages of each image (timings are sent back in the record, see _withTimings)
+    global _workerPipeline
+    # Workers are already parallel, avoid oversubscribing cores with opencv threads
+    cv2.setNumThreads(1)
+    enableProfiling(profile)
+    landmarkMode = pipelineOptions.get('landmarkMode', '68+81')
+    models = configureModels(predictor68Path, predictor81Path).load(requiredModels(landmarkMode))
+    _workerPipeline = FacePipeline(models, **pipelineOptions)
+    if cacheFolder:
+        _workerPipeline = CachedPipeline(_workerPipeline, LandmarkCache(cacheFolder, cacheMaxBytes))
+
+
+def _withTimings(record):
+    # Function to attach the stages timings of the last image to its record (when profiling)
+    # Output: record (dictionary with a 'timings' per-image record, even if record was None)
+    profiler = getProfiler()
+    if not profiler.enabled or not profiler.images:
+        return record
+    return dict(record or {}, timings=profiler.images.pop())
+
+
+def processImage(path, outputFolder, options, returnRecord=False, ext='.jpg', quality=95):
+    # Function to run detect -> align -> landmarks -> features on one image & write the features
+    # Output: (path, status, number of features written, record)
+    #         status: 'ok', 'no_face', 'unreadable' or 'error: ...' (a failing image doesn't stop the batch)
+    #         record: pipeline result without the images (for DatasetWriter) if returnRecord, else None
+    #                 when profiling, it also holds the stages timings of the image ('timings')
+    with getProfiler().image(path):
+        try:
+            path, status, written, record = _processImage(path, outputFolder, options, returnRecord, ext, quality)
+        except Exception as error:
+            path, status, written, record = path, 'error: %s' % error, 0, None
+    return path, status, written, _withTimings(record)
+
+
+def _processImage(path, outputFolder, options, returnRecord, ext, quality):
+    if isinstance(_workerPipeline, CachedPipeline) or _workerPipeline.detectionReduction:
+        # Unreadable files are counted by the pipeline (processFile returns None for them too)
+        stats = (_workerPipeline.pipeline if isinstance(_workerPipeline, CachedPipeline) else _workerPipeline).stats
+        unreadable = stats['unreadable']
+        result = _workerPipeline.processFile(path)
+        if stats['unreadable'] > unreadable:
+            return path, 'unreadable', 0, None
+    else:
+        image = cv2.imread(path)
+        if image is None:
+            return path, 'unreadable', 0, None
+        result = _workerPipeline.process(image)
+    if result is None:
+        return path, 'no_face', 0, None
+
+    features = face_parts_imgs(result['aligned_image'], result['landmarks'], list(options))
+    written = writeFeatures(path, features, outputFolder, ext, encodeParameters(ext, quality))
+    return path, 'ok', written, resultRecord(result) if returnRecord else None
+
+
+def resultRecord(result):
+    # Function to get the pipeline result without the images (for DatasetWriter)
+    return {key: result[key] for key in ('landmarks', 'face_box', 'angle', 'forehead_clear') if key in result}
+
+
+def computeFeatures(image, options, returnRecord=False):
+    # Function to run detect -> align -> landmarks -> features on a decoded image (compute stage of run_staged)
+    # Output: (status, {'feature_name': array(image)}, record)
+    with getProfiler().image(None):
+        status, features, record = _computeFeatures(image, options, returnRecord)
+    return status, features, _withTimings(record)
+
+
+def _computeFeatures(image, options, returnRecord):
+    result = _workerPipeline.process(image)
+    if result is None:
+        return 'no_face', None, None
+    features = face_parts_imgs(result['aligned_image'], result['landmarks'], list(options))
+    # Send only the crops back (not the whole aligned image the views belong to)
+    features = {key: features[key].copy() for key in features}
+    return 'ok', features, resultRecord(result) if returnRecord else None
+
+
+def _completed(pending, ordered):
+    # Function to wait for (at least) one task & yield its result
+    if ordered:
+        yield pending.popleft().result()
+    else:
+        done, notDone = wait(pending, return_when=FIRST_COMPLETED)
+        pending.difference_update(done)
+        for future in done:
+            yield future.result()
+
+
+def run_batch(folder, outputFolder, workers=None, ordered=True, options=('all',), maxInFlight=None,
+              predictor68Path=DEFAULT_PREDICTOR68_PATH, predictor81Path=DEFAULT_PREDICTOR81_PATH,
+              cacheFolder=None, cacheMaxBytes=512 * 1024 * 1024, returnRecords=False, ext='.jpg', quality=95,
+              profile=False, **pipelineOptions):
+    # Function to process all images of a folder with a pool of worker processes
+    # pipelineOptions: keyword arguments of FacePipeline (allowEnhancement, alignment, detectionScales...)
+    # Results (path, status, number of features, record) are yielded in input order if ordered, else as they finish
+    # Number of images in flight is bounded (maxInFlight), so memory doesn't grow with folder size
+    workers = workers or os.cpu_count() or 1
+    maxInFlight = maxInFlight or workers * 4
+    os.makedirs(outputFolder, exist_ok=True)
+
+    pending = deque() if ordered else set()
+    with ProcessPoolExecutor(workers, initializer=initWorker,
+                             initargs=(predictor68Path, predictor81Path, pipelineOptions,
+                                       cacheFolder, cacheMaxBytes, profile)) as executor:
+        for path in iterImagePaths(folder):
+            if len(pending) >= maxInFlight:
+                yield from _completed(pending, ordered)
+            future = executor.submit(processImage, path, outputFolder, tuple(options), returnRecords, ext, quality)
+            if ordered:
+                pending.append(future)
+            else:
+                pending.add(future)
+        while pending:
+            yield from _completed(pending, ordered)
+
+
+def run_staged(folder, outputFolder, workers=None, ordered=True, options=('all',), maxInFlight=None,
+               predictor68Path=DEFAULT_PREDICTOR68_PATH, predictor81Path=DEFAULT_PREDICTOR81_PATH,
+               returnRecords=False, ext='.jpg', quality=95, decodeWorkers=4, writeWorkers=2, profile=False,
+               **pipelineOptions):
+    # Function to process all images of a folder with separate I/O stages (see io_pipeline.StagedPipeline):
+    # decoding & encoding run in thread pools of this process, overlapping the compute worker processes
+    # Output (generator): same as run_batch
+    workers = workers or os.cpu_count() or 1
+    maxInFlight = maxInFlight or workers * 4
+    compute = partial(computeFeatures, options=tuple(options), returnRecord=returnRecords)
+    with ProcessPoolExecutor(workers, initializer=initWorker,
+                             initargs=(predictor68Path, predictor81Path, pipelineOptions, None, None, profile)) as executor:
+        staged = StagedPipeline(compute, executor, outputFolder, decodeWorkers, writeWorkers, maxInFlight, ext, quality)
+        yield from staged.run(iterImagePaths(folder), ordered)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract facial features of all images in a folder')
+    parser.add_argument('input', help='folder of images')
+    parser.add_argument('output', help='folder to write features into (one sub-folder per image)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: cpu count)')
+    parser.add_argument('--unordered', action='store_true', help='write/report results as soon as they finish')
+    parser.add_argument('--options', nargs='+', default=['all'], help='features to extract')
+    parser.add_argument('--no-enhancement', action='store_true', help='disable forehead landmarks enhancement')
+    parser.add_argument('--max-in-flight', type=int, default=None, help='maximum number of images queued at once')
+    parser.add_argument('--alignment', choices=['full', 'roi'], default='full',
+                        help="'roi' rotates only the padded face region (faster on large images)")
+    parser.add_argument('--min-face-size', type=int, default=None,
+                        help='smallest face width (pixels) to find, faces are detected on a downscaled copy')
+    parser.add_argument('--full-resolution-fallback', action='store_true',
+                        help='detect at native resolution too when the downscaled copy has no face (slower on images '
+                             'without faces, finds faces smaller than --min-face-size)')
+    parser.add_argument('--reduced-decode', action='store_true',
+                        help='detect faces on a reduced resolution decode (needs --min-face-size)')
+    parser.add_argument('--landmark-mode', choices=LANDMARK_MODES, default='68+81',
+                        help="'81' runs only the 81 points predictor (faster, less accurate face points)")
+    parser.add_argument('--tier', choices=TIER_NAMES, default=None,
+                        help='quality tier (replaces --no-enhancement, --alignment, --landmark-mode & the detection pyramid)')
+    parser.add_argument('--cache', default=None, help='folder of the landmarks cache (re-use results of seen images)')
+    parser.add_argument('--cache-size', type=int, default=512, help='maximum size of the cache (MB)')
+    parser.add_argument('--dataset', default=None, help='also export landmarks & boxes as a columnar dataset to this folder')
+    parser.add_argument('--format', choices=['jpg', 'png', 'webp'], default='jpg', help='features images format')
+    parser.add_argument('--quality', type=int, default=95, help='JPEG/WebP quality')
+    parser.add_argument('--staged', action='store_true',
+                        help='decode & write in thread pools of the main process, overlapping compute workers')
+    parser.add_argument('--decode-threads', type=int, default=4)
+    parser.add_argument('--write-threads', type=int, default=2)
+    parser.add_argument('--profile', default=None, help='write per-stage timings (JSON report) to this file')
+    parser.add_argument('--predictor68', default=DEFAULT_PREDICTOR68_PATH)
+    parser.add_argument('--predictor81', default=DEFAULT_PREDICTOR81_PATH)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = {}
+    fallback = args.full_resolution_fallback
+    detectionScales = pyramidScales(args.min_face_size, fullResolution=fallback) if args.min_face_size else None
+    detectionReduction = None
+    if args.reduced_decode:
+        if not args.min_face_size:
+            parser.error('--reduced-decode needs --min-face-size')
+        # Reduced decoding replaces the coarse levels of the detection pyramid
+        # (a tier without upsampling finds larger faces only: the reduction depends on it)
+        detectionReduction = (tierReduction(args.tier, args.min_face_size) if args.tier
+                              else reductionForFaceSize(args.min_face_size))
+        detectionScales = pyramidScales(args.min_face_size / detectionReduction, fullResolution=fallback)
+    if args.tier:
+        pipelineOptions = tierPipelineOptions(args.tier, args.min_face_size, detectionReduction)
+    else:
+        pipelineOptions = {'allowEnhancement': not args.no_enhancement, 'alignment': args.alignment,
+                           'detectionScales': detectionScales, 'detectionReduction': detectionReduction,
+                           'landmarkMode': args.landmark_mode}
+    if args.staged:
+        if args.cache or args.reduced_decode:
+            parser.error('--cache & --reduced-decode are not supported with --staged (images are decoded by the I/O stage)')
+        results = run_staged(args.input, args.output, args.workers, not args.unordered, args.options,
+                             args.max_in_flight, args.predictor68, args.predictor81, args.dataset is not None,
+                             '.' + args.format, args.quality, args.decode_threads, args.write_threads,
+                             args.profile is not None, **pipelineOptions)
+    else:
+        results = run_batch(args.input, args.output, args.workers, not args.unordered, args.options,
+                            args.max_in_flight, args.predictor68, args.predictor81, args.cache,
+                            args.cache_size * 1024 * 1024, args.dataset is not None, '.' + args.format,
+                            args.quality, args.profile is not None, **pipelineOptions)
+    dataset = DatasetWriter(args.dataset) if args.dataset else None
+    profiler = getProfiler()
+    for path, status, written, record in results:
+        # Errors are counted together (the message is printed per image)
+        kind = status.split(':')[0]
+        counts[kind] = counts.get(kind, 0) + 1
+        if record is not None and 'timings' in record:
+            timings = record.pop('timings')
+            timings['image'] = path
+            profiler.mergeImage(timings)
+        if dataset is not None and status == 'ok' and record is not None:
+            dataset.add(os.path.basename(path), record)
+        print(path, status, written)
+    if dataset is not None:
+        dataset.close()
+    if args.profile:
+        profiler.save(args.profile)
+
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    print('processed', total, 'images in', round(elapsed, 2), 's', counts,
+          '(%.2f images/s)' % (total / elapsed if elapsed > 0 else 0))
+
+
+if __name__ == '__main__':
+    main()
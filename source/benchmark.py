@@ -0,0 +1,306 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import dlib
+import numpy as np
+from models import DEFAULT_PREDICTOR68_PATH, DEFAULT_PREDICTOR81_PATH, configureModels
+from pipeline import FacePipeline
+from detection import facial_landmarks, facial_landmarks_all, align_face
+from extractor import face_parts_imgs, face_parts_imgs_batch
+import batch
+
+
+# Default workloads: width of each tile (pixels, the face size is fixed by it) x number of faces (tiles of the sample
+# image), the synthetic image grows with the number of faces
+DEFAULT_RESOLUTIONS = (640, 1280, 1920)
+DEFAULT_FACE_COUNTS = (1, 4)
+SINGLE_FEATURE = 'left_eye'
+
+# Cold start budget of a worker process: import of the worker entry point (batch), models loading & memory
+COLD_START_BUDGET = {'import_ms': 600, 'load_ms': 3000, 'max_rss_mb': 600}
+# Modules that must stay out of the compute path (visualization & reporting only)
+HEAVY_MODULES = ('scipy', 'matplotlib', 'pandas', 'imutils')
+
+# Run in a fresh interpreter: time the worker entry point import & models loading
+_COLD_START_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+import batch
+imported = time.perf_counter()
+if sys.argv[1] == 'load':
+    batch.initWorker(sys.argv[2], sys.argv[3], {})
+loaded = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'load_ms': (loaded - imported) * 1000,
+                  'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'heavy_modules': [name for name in %r if name in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def syntheticImage(baseImage, faces=1, width=None):
+    # Function to build a workload image: baseImage resized to width, tiled in a (near) square grid of faces tiles
+    # (same face size whatever the number of faces, so timings across face counts give the per face cost)
+    if width:
+        scale = width / float(baseImage.shape[1])
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        baseImage = cv2.resize(baseImage, None, fx=scale, fy=scale, interpolation=interpolation)
+    columns = int(np.ceil(np.sqrt(faces)))
+    rows = int(np.ceil(faces / columns))
+    canvas = np.zeros((rows * baseImage.shape[0], columns * baseImage.shape[1], 3), dtype=np.uint8)
+    for i in range(faces):
+        row, column = divmod(i, columns)
+        canvas[row * baseImage.shape[0]:(row + 1) * baseImage.shape[0],
+               column * baseImage.shape[1]:(column + 1) * baseImage.shape[1]] = baseImage
+    return canvas
+
+
+def timeCall(function, repeat=10, warmup=2):
+    # Function to time a call (milliseconds), warmup calls are not measured
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    times = np.array(times)
+    return {'repeat': repeat, 'mean_ms': float(times.mean()), 'min_ms': float(times.min()),
+            'p50_ms': float(np.percentile(times, 50)), 'p95_ms': float(np.percentile(times, 95))}
+
+
+def benchmarkStages(image, models, repeat=10, warmup=2):
+    # Function to time each stage separately & end to end on one image
+    # Output: {'benchmark name': timings}
+    landmarks = facial_landmarks(image, allowEnhancement=True, models=models)
+    if landmarks is None:
+        return {}
+    eyePoints = facial_landmarks(image, eyeOnlyMode=True, models=models)
+    aligned = align_face(image, eyePoints)
+    alignedLandmarks = facial_landmarks(aligned, allowEnhancement=True, models=models)
+    if alignedLandmarks is None:
+        alignedLandmarks = landmarks
+    # Every face of the workload (facial_landmarks processes the first face only)
+    allLandmarks = facial_landmarks_all(image, allowEnhancement=True, models=models)
+
+    def endToEnd():
+        # Original flow of main: eye points -> align -> landmarks -> features
+        eyes = facial_landmarks(image, eyeOnlyMode=True, models=models)
+        alignedImage = align_face(image, eyes)
+        points = facial_landmarks(alignedImage, allowEnhancement=True, models=models)
+        if points is not None:
+            face_parts_imgs(alignedImage, points, ['all'])
+
+    benchmarks = {
+            'landmarks_eye_only': lambda: facial_landmarks(image, eyeOnlyMode=True, models=models),
+            'landmarks_plain': lambda: facial_landmarks(image, models=models),
+            'landmarks_enhanced': lambda: facial_landmarks(image, allowEnhancement=True, models=models),
+            'landmarks_81_only': lambda: facial_landmarks(image, allowEnhancement=True, models=models,
+                                                          landmarkMode='81'),
+            'align_face': lambda: align_face(image, eyePoints),
+            'face_parts_all': lambda: face_parts_imgs(aligned, alignedLandmarks, ['all']),
+            'face_parts_single': lambda: face_parts_imgs(aligned, alignedLandmarks, [SINGLE_FEATURE]),
+            # Per face cost (compare across the face counts of a resolution)
+            'landmarks_all_faces': lambda: facial_landmarks_all(image, allowEnhancement=True, models=models),
+            'face_parts_all_faces': lambda: face_parts_imgs_batch(image, allLandmarks, ['all']),
+            'end_to_end': endToEnd
+            }
+    return {name: timeCall(function, repeat, warmup) for name, function in benchmarks.items()}
+
+
+def benchmarkThroughput(images, workers, predictor68Path, predictor81Path, options=('all',), rounds=3, models=None):
+    # Function to measure the end to end throughput (images/s) of FacePipeline + features extraction
+    # workers = 0 -> single process: a FacePipeline of this process (models: loaded FaceModels, default opencv threads)
+    #           else a pool of worker processes (see batch.initWorker, one opencv thread per worker)
+    # Model loading is excluded (done before the clock starts)
+    pipelineOptions = {'allowEnhancement': True}
+    images = list(images) * rounds
+    if workers == 0:
+        pipeline = FacePipeline(models if models is not None else configureModels(predictor68Path, predictor81Path),
+                                **pipelineOptions)
+        pipeline.process(images[0])
+        start = time.perf_counter()
+        for image in images:
+            result = pipeline.process(image)
+            if result is not None:
+                face_parts_imgs(result['aligned_image'], result['landmarks'], list(options))
+        elapsed = time.perf_counter() - start
+    else:
+        with ProcessPoolExecutor(workers, initializer=batch.initWorker,
+                                 initargs=(predictor68Path, predictor81Path, pipelineOptions)) as executor:
+            # Warm up every worker (models loaded) before measuring
+            list(executor.map(batch.computeFeatures, images[:workers], [options] * workers))
+            start = time.perf_counter()
+            list(executor.map(batch.computeFeatures, images, [options] * len(images)))
+            elapsed = time.perf_counter() - start
+    return {'images': len(images), 'seconds': elapsed, 'images_per_s': len(images) / elapsed if elapsed > 0 else 0.0}
+
+
+def measureColdStart(predictor68Path=DEFAULT_PREDICTOR68_PATH, predictor81Path=DEFAULT_PREDICTOR81_PATH,
+                     loadModels=True, runs=3):
+    # Function to measure the cold start of a worker (fresh interpreter each run), output: median of the runs
+    # {'process_ms' (whole process, interpreter startup included), 'import_ms', 'load_ms', 'max_rss_mb',
+    #  'heavy_modules' (HEAVY_MODULES imported by the worker entry point)}
+    measures = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', _COLD_START_SCRIPT, 'load' if loadModels else 'import',
+                                 predictor68Path, predictor81Path], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        measure = json.loads(output.strip().splitlines()[-1])
+        measure['process_ms'] = (time.perf_counter() - start) * 1000
+        measures.append(measure)
+    result = {key: float(np.median([measure[key] for measure in measures]))
+              for key in ('process_ms', 'import_ms', 'load_ms', 'max_rss_mb')}
+    result['heavy_modules'] = sorted(set(name for measure in measures for name in measure['heavy_modules']))
+    return result
+
+
+def checkColdStart(measure, budget=COLD_START_BUDGET):
+    # Function to check a cold start measure against its budget, output: list of violations (empty if within)
+    violations = ['%s %.0f > %.0f' % (key, measure[key], limit) for key, limit in budget.items()
+                  if key in measure and measure[key] > limit]
+    if measure.get('heavy_modules'):
+        violations.append('heavy modules imported: %s' % ', '.join(measure['heavy_modules']))
+    return violations
+
+
+def environment():
+    # Function to describe where the benchmark ran (results are only comparable on the same environment)
+    return {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'dlib': dlib.__version__,
+            'opencv_threads': cv2.getNumThreads()
+            }
+
+
+def run_benchmarks(imagePath, resolutions=DEFAULT_RESOLUTIONS, faceCounts=DEFAULT_FACE_COUNTS, repeat=10, warmup=2,
+                   workers=(0,), predictor68Path=DEFAULT_PREDICTOR68_PATH, predictor81Path=DEFAULT_PREDICTOR81_PATH):
+    # Function to run all benchmarks on the synthetic workloads built from imagePath
+    # workers: pool sizes of the throughput benchmark (0 -> single process)
+    # Output: report dictionary {'environment', 'settings', 'results': [{'workload', 'benchmark', timings...}]}
+    baseImage = cv2.imread(imagePath)
+    if baseImage is None:
+        raise IOError('can not read %s' % imagePath)
+    models = configureModels(predictor68Path, predictor81Path).load()
+    # Environment of the stages timings (captured before any pool runs)
+    environmentInfo = environment()
+    results = []
+    workloads = []
+    for width in resolutions:
+        for faces in faceCounts:
+            image = syntheticImage(baseImage, faces, width)
+            workload = '%dx%d_%dfaces_%dpx' % (image.shape[1], image.shape[0], faces, width)
+            workloads.append(image)
+            for name, timings in benchmarkStages(image, models, repeat, warmup).items():
+                results.append(dict(workload=workload, benchmark=name, **timings))
+    for poolSize in workers:
+        throughput = benchmarkThroughput(workloads, poolSize, predictor68Path, predictor81Path, models=models)
+        name = 'throughput_single_process' if poolSize == 0 else 'throughput_pool_%d' % poolSize
+        results.append(dict(workload='all', benchmark=name, **throughput))
+    return {
+            'environment': environmentInfo,
+            'settings': {'image': os.path.basename(imagePath), 'resolutions': list(resolutions),
+                         'face_counts': list(faceCounts), 'repeat': repeat, 'warmup': warmup,
+                         'workers': list(workers), 'model_load_s': models.loadTimes},
+            'results': results
+            }
+
+
+def compare(baseline, current, threshold=0.1):
+    # Function to compare 2 reports (same workloads), a benchmark regresses if it is slower by more than threshold
+    # Output: list of rows {'workload', 'benchmark', 'baseline', 'current', 'ratio', 'regression'}
+    #         (ratio > 1 -> slower, compares p50 timings, or images/s for throughput)
+    baselineResults = {(row['workload'], row['benchmark']): row for row in baseline['results']}
+    rows = []
+    for row in current['results']:
+        reference = baselineResults.get((row['workload'], row['benchmark']))
+        if reference is None:
+            continue
+        if 'images_per_s' in row:
+            before, after = reference['images_per_s'], row['images_per_s']
+            ratio = before / after if after > 0 else float('inf')
+        else:
+            before, after = reference['p50_ms'], row['p50_ms']
+            ratio = after / before if before > 0 else float('inf')
+        rows.append({'workload': row['workload'], 'benchmark': row['benchmark'], 'baseline': before,
+                     'current': after, 'ratio': ratio, 'regression': ratio > 1 + threshold})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the facial landmarks & features pipeline')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run the benchmarks & save the report')
+    run.add_argument('--image', default='../sample.jpg', help='image tiled to build the workloads')
+    run.add_argument('--resolutions', type=int, nargs='+', default=list(DEFAULT_RESOLUTIONS),
+                     help='width of each face tile (the image grows with --faces)')
+    run.add_argument('--faces', type=int, nargs='+', default=list(DEFAULT_FACE_COUNTS))
+    run.add_argument('--repeat', type=int, default=10)
+    run.add_argument('--warmup', type=int, default=2)
+    run.add_argument('--workers', type=int, nargs='+', default=[0, os.cpu_count() or 1],
+                     help='pool sizes of the throughput benchmark (0 = single process)')
+    run.add_argument('--output', default='benchmark.json')
+    run.add_argument('--predictor68', default=DEFAULT_PREDICTOR68_PATH)
+    run.add_argument('--predictor81', default=DEFAULT_PREDICTOR81_PATH)
+    check = commands.add_parser('compare', help='compare a report against a baseline (exit code 1 on regression)')
+    check.add_argument('baseline')
+    check.add_argument('current')
+    check.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown (0.1 = 10%%)')
+    coldStart = commands.add_parser('cold-start', help='measure the worker cold start against its budget '
+                                                       '(exit code 1 if over budget)')
+    coldStart.add_argument('--runs', type=int, default=3)
+    coldStart.add_argument('--no-models', action='store_true', help='measure the imports only')
+    coldStart.add_argument('--import-budget-ms', type=float, default=COLD_START_BUDGET['import_ms'])
+    coldStart.add_argument('--load-budget-ms', type=float, default=COLD_START_BUDGET['load_ms'])
+    coldStart.add_argument('--rss-budget-mb', type=float, default=COLD_START_BUDGET['max_rss_mb'])
+    coldStart.add_argument('--predictor68', default=DEFAULT_PREDICTOR68_PATH)
+    coldStart.add_argument('--predictor81', default=DEFAULT_PREDICTOR81_PATH)
+    args = parser.parse_args()
+
+    if args.command == 'cold-start':
+        measure = measureColdStart(args.predictor68, args.predictor81, not args.no_models, args.runs)
+        print(json.dumps(measure, indent=2))
+        violations = checkColdStart(measure, {'import_ms': args.import_budget_ms, 'load_ms': args.load_budget_ms,
+                                              'max_rss_mb': args.rss_budget_mb})
+        for violation in violations:
+            print('OVER BUDGET:', violation)
+        if violations:
+            sys.exit(1)
+        return
+
+    if args.command == 'run':
+        report = run_benchmarks(args.image, args.resolutions, args.faces, args.repeat, args.warmup, args.workers,
+                                args.predictor68, args.predictor81)
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        for row in report['results']:
+            print(row)
+        return
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    if baseline['environment'] != current['environment']:
+        print('warning: reports come from different environments, timings may not be comparable')
+    rows = compare(baseline, current, args.threshold)
+    for row in rows:
+        print('%-24s %-22s %10.2f -> %10.2f  x%.2f%s' % (row['workload'], row['benchmark'], row['baseline'],
+                                                         row['current'], row['ratio'],
+                                                         '  REGRESSION' if row['regression'] else ''))
+    if any(row['regression'] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
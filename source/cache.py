@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import tempfile
+import cv2
+import numpy as np
+from extractor import face_parts_imgs
+from detection import requiredModels
+
+
+# Hashes of model files, by (path, size, modification time) -> hashed once per process
+_fileHashes = {}
+
+def fileHash(path, chunkSize=1 << 20):
+    # Function to get the sha256 of a file (cached while the file is unchanged)
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _fileHashes:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunkSize), b''):
+                digest.update(chunk)
+        _fileHashes[key] = digest.hexdigest()
+    return _fileHashes[key]
+
+
+class LandmarkCache:
+    # On-disk cache of pipeline results (81 landmarks + alignment transform), keyed by
+    # image bytes hash + model files hashes + pipeline parameters
+    # Size is bounded (maxBytes), least recently used entries are evicted first
+
+    def __init__(self, folder, maxBytes=512 * 1024 * 1024):
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        os.makedirs(folder, exist_ok=True)
+        self._size = sum(size for path, size, used in self._entries())
+
+    def _entries(self):
+        # Function to list cache files as (path, size, last use time)
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.name.endswith('.npz'):
+                stat = entry.stat()
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def key(self, imageBytes, models, parameters):
+        # Function to build the cache key of an image for given models & pipeline parameters
+        digest = hashlib.sha256()
+        digest.update(hashlib.sha256(imageBytes).digest())
+        # Only the model files the landmark mode uses (the 68 predictor may be missing in '81' mode)
+        for name in requiredModels(parameters.get('landmarkMode', '68+81')):
+            if name != 'detector':
+                digest.update(fileHash(getattr(models, name + 'Path')).encode())
+        digest.update(json.dumps(parameters, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        # Function to get a cached result: None if missing, {'landmarks': None} if no face was found
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                entry = {name: data[name] for name in data.files}
+            # Mark as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            # Missing, or evicted by another worker meanwhile
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        if entry['found'] == 0:
+            return {'landmarks': None}
+        return {
+                'landmarks': entry['landmarks'],
+                'rotation_matrix': entry['rotation_matrix'],
+                'aligned_size': tuple(int(value) for value in entry['aligned_size']),
+                'angle': float(entry['angle']),
+                'face_box': tuple(int(value) for value in entry['face_box']),
+                'forehead_clear': None if entry['forehead_clear'] < 0 else bool(entry['forehead_clear'])
+                }
+
+    def put(self, key, result):
+        # Function to store a pipeline result (None = no face found)
+        path = self._path(key)
+        # Unique temporary file: workers may store the same key at once (duplicate images)
+        descriptor, temporaryPath = tempfile.mkstemp(suffix='.tmp', dir=self.folder)
+        with os.fdopen(descriptor, 'wb') as file:
+            if result is None:
+                np.savez(file, found=0)
+            else:
+                alignedShape = result['aligned_image'].shape
+                foreheadClear = result.get('forehead_clear')
+                np.savez(file, found=1, landmarks=result['landmarks'], rotation_matrix=result['rotation_matrix'],
+                         aligned_size=np.array([alignedShape[1], alignedShape[0]]), angle=result.get('angle', 0.0),
+                         face_box=np.array(result.get('face_box', (0, 0, 0, 0))),
+                         forehead_clear=-1 if foreheadClear is None else int(foreheadClear))
+        try:
+            os.replace(temporaryPath, path)
+            self._size += os.path.getsize(path)
+        except OSError:
+            # Lost a race with another worker (entry stored or evicted meanwhile), the result is still valid
+            if os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
+            return
+        if self._size > self.maxBytes:
+            self.evict()
+
+    def evict(self):
+        # Function to delete least recently used entries until the cache fits in maxBytes
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for path, size, used in entries)
+        for path, size, used in entries:
+            if self._size <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+            self.stats['evictions'] += 1
+
+
+def alignFromCache(image, entry):
+    # Function to re-create the aligned image of a cached result (cheap compared to detection)
+    return cv2.warpAffine(image, entry['rotation_matrix'], entry['aligned_size'], flags=cv2.INTER_LINEAR)
+
+
+class CachedPipeline:
+    # FacePipeline with a LandmarkCache: detection & predictors run only for images not seen before
+
+    def __init__(self, pipeline, cache):
+        self.pipeline = pipeline
+        self.cache = cache
+
+    def imageKey(self, imageBytes):
+        return self.cache.key(imageBytes, self.pipeline.models, self.pipeline.parameters())
+
+    def processFile(self, path):
+        # Function to process an image file (same output as FacePipeline.processFile, unreadable files are counted
+        # in the stats of the pipeline)
+        with open(path, 'rb') as file:
+            imageBytes = file.read()
+        key = self.imageKey(imageBytes)
+        entry = self.cache.get(key)
+        if entry is not None and entry['landmarks'] is None:
+            return None
+        if entry is None and self.pipeline.detectionReduction and self.pipeline.detectionReduction != 1:
+            # Reduced resolution decoding for detection (part of the key)
+            unreadable = self.pipeline.stats['unreadable']
+            result = self.pipeline.processFile(path)
+            if self.pipeline.stats['unreadable'] == unreadable:
+                self.cache.put(key, result)
+            return result
+        image = cv2.imdecode(np.frombuffer(imageBytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            self.pipeline.stats['unreadable'] += 1
+            return None
+        if entry is not None:
+            return {
+                    'aligned_image': alignFromCache(image, entry),
+                    'landmarks': entry['landmarks'],
+                    'rotation_matrix': entry['rotation_matrix'],
+                    'angle': entry['angle'],
+                    'face_box': entry['face_box'],
+                    'forehead_clear': entry['forehead_clear'],
+                    'cached': True
+                    }
+        result = self.pipeline.process(image)
+        self.cache.put(key, result)
+        return result
+
+
+def extract_from_cache(cachedPipeline, path, options):
+    # Function to extract features of an image from the cache only (no detection, no predictors)
+    # Output: dictionary {'feature_name': array(image)}, None if the image isn't cached (or has no face)
+    with open(path, 'rb') as file:
+        imageBytes = file.read()
+    entry = cachedPipeline.cache.get(cachedPipeline.imageKey(imageBytes))
+    if entry is None or entry['landmarks'] is None:
+        return None
+    image = cv2.imdecode(np.frombuffer(imageBytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return face_parts_imgs(alignFromCache(image, entry), entry['landmarks'], options)
@@ -0,0 +1,72 @@
+import cv2
+import numpy as np
+from profiling import getProfiler
+
+
+def toGrayscale(image):
+    # Function to get the grayscale version of the image (input may already be grayscale)
+    if isinstance(image, ImageContext):
+        return image.gray
+    if image.ndim == 2:
+        return image
+    channels = image.shape[2] if image.ndim == 3 else None
+    if channels == 1:
+        return image[:, :, 0]
+    if channels == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if channels == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+    raise ValueError('expected a grayscale, BGR or BGRA image, got an array of shape %s' % (image.shape,))
+
+
+class ImageContext:
+    # Per image holder of derived images, each one is computed once & shared by all pipeline stages:
+    #    gray          -> grayscale image (detector, predictors, clearForehead, skin color sampling)
+    #    level(scale)  -> downscaled grayscale copies (detection pyramid levels)
+    #    warp(matrix)  -> aligned variants of the image (each one is an ImageContext too)
+
+    def __init__(self, image, gray=None):
+        self.image = image
+        self._gray = gray
+        self._levels = {}
+        self._warped = {}
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            with getProfiler().stage('grayscale'):
+                self._gray = toGrayscale(self.image)
+        return self._gray
+
+    def level(self, scale):
+        # Function to get the grayscale image downscaled by scale (1 -> gray itself)
+        if scale >= 1:
+            return self.gray
+        if scale not in self._levels:
+            self._levels[scale] = cv2.resize(self.gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return self._levels[scale]
+
+    def warp(self, matrix, size=None):
+        # Function to get the image warped by an affine matrix (2x3), size = (width, height) of the output
+        size = tuple(size) if size is not None else self.image.shape[1::-1]
+        key = (np.asarray(matrix, dtype=np.float64).tobytes(), size)
+        if key not in self._warped:
+            with getProfiler().stage('align'):
+                warped = cv2.warpAffine(self.image, matrix, size, flags=cv2.INTER_LINEAR)
+            self._warped[key] = ImageContext(warped)
+        return self._warped[key]
+
+    def release(self):
+        # Function to free the derived images (e.g. once the image is done)
+        self._gray = None
+        self._levels.clear()
+        self._warped.clear()
+
+
+def asContext(image):
+    # Function to wrap an image in an ImageContext (contexts are returned as they are)
+    return image if isinstance(image, ImageContext) else ImageContext(image)
@@ -1,12 +1,11 @@
 import cv2
 import dlib
-from imutils import face_utils
 import numpy as np
-from scipy.spatial import Delaunay
-import matplotlib.pyplot as plt
-from matplotlib import transforms
 import math
-from geometry import slope
+from geometry import slope, transformPoints
+from models import getModels
+from context import ImageContext, asContext, toGrayscale
+from profiling import getProfiler
 
 
 
@@ -60,6 +59,38 @@ def moveUp(grayscale_image, point, avgSkinColor, foreheadHeight):
         point[1] = originalPoint[1] - (originalPoint[1] * portionOfOriginalPointY)
     return point
 
+def moveUpPoints(grayscale_image, points, avgSkinColor, foreheadHeight):
+    # Function to move many landmarks points at once, based on skincolor (same output as moveUp for each point)
+    # The columns above all points are scanned in one operation: the pixels every (N steps) above each point
+    # are compared to the color range & the first one outside the range is where the point stops
+    steps = 5
+    portionOfOriginalPointY = 0.275
+    points = np.array(points, copy=True)
+    colorRange = getAllowedColorRange(avgSkinColor)
+    pointsX = points[:, 0]
+    originalY = points[:, 1].copy()
+    
+    # Step at which each point goes out of image boundary (Y < 0)
+    lastStep = np.where(originalY < 0, 0, originalY // steps + 1)
+    stepsRange = np.arange(lastStep.max() + 1)
+    validSteps = stepsRange[np.newaxis, :] <= lastStep[:, np.newaxis]
+    columnsY = originalY[:, np.newaxis] - steps * stepsRange[np.newaxis, :]
+    columnsY = np.where(validSteps, columnsY, originalY[:, np.newaxis])
+    colors = grayscale_image[columnsY, pointsX[:, np.newaxis]]
+    
+    # First step with a strong change of color (outside color range)
+    outOfRange = validSteps & ~((colors > colorRange[0]) & (colors < colorRange[1]))
+    stopped = outOfRange.any(axis=1)
+    firstStop = np.argmax(outOfRange, axis=1)
+    
+    # Points that went out of image boundary get back to original location, with a little bit higher
+    keptY = np.trunc(originalY - (originalY * portionOfOriginalPointY)).astype(points.dtype)
+    movedY = np.where(stopped, originalY - steps * firstStop, keptY)
+    # if the pixel is moved too high than expected (3/4 forehead height): keep close to original
+    movedY = np.where(np.abs(originalY - movedY) > (foreheadHeight * 0.75), keptY, movedY)
+    points[:, 1] = movedY
+    return points
+
 def clearForehead(forehead, avgSkinColor):
     # Function to detect if the forehead is clear or covered with hair (it corrupts the enhancement of landmarks points)
     clarityThreshold = 85
@@ -74,100 +105,247 @@ def clearForehead(forehead, avgSkinColor):
     return isClear
 
 
-def facial_landmarks(image, eyeOnlyMode=False, allowEnhancement=False):
-    # Function to perform facial landmark detection on the whole face
+# Size (pixels) of the smallest face found by the dlib HOG detector without upsampling
+DETECTOR_WINDOW_SIZE = 80
 
-    # Use dlib 68 & 81 to predict landmarks points coordinates
-    detector = dlib.get_frontal_face_detector()
-    predictor68 = dlib.shape_predictor('../shape_predictor_68_face_landmarks.dat')
-    predictor81 = dlib.shape_predictor('../shape_predictor_81_face_landmarks.dat')
-    
-    # Grayscale image
-    try:
-        grayscale_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    except:
-        grayscale_image = image
+def pyramidScales(minFaceSize, upsample=1, levels=1, fullResolution=False):
+    # Function to get the detection scales (coarse to fine) for faces at least minFaceSize pixels wide
+    # The coarsest scale brings the smallest wanted face to the smallest size the detector finds (it already finds
+    # every face of minFaceSize), each next level doubles the scale (retries for faces close to the detector limit)
+    # fullResolution: end with a native resolution pass (1.0), finds faces smaller than minFaceSize too but images
+    #                 without faces then cost more than a plain native detection
+    smallestDetectable = DETECTOR_WINDOW_SIZE / (2 ** upsample)
+    scale = min(1.0, smallestDetectable / float(minFaceSize))
+    scales = [min(1.0, scale * (2 ** level)) for level in range(levels)]
+    if fullResolution:
+        scales.append(1.0)
+    return sorted(set(scales))
+
+def reductionForFaceSize(minFaceSize, upsample=1, reductions=(1, 2, 4, 8)):
+    # Function to get the largest decode reduction (1/2, 1/4, 1/8 JPEG decoding) that still finds faces
+    # at least minFaceSize pixels wide
+    smallestDetectable = DETECTOR_WINDOW_SIZE / (2 ** upsample)
+    usable = [reduction for reduction in reductions if minFaceSize / reduction >= smallestDetectable]
+    return max(usable) if usable else 1
+
+def scaleRectangle(rectangle, scale):
+    # Function to scale a dlib rectangle (e.g. from a downscaled image back to full resolution)
+    return dlib.rectangle(int(round(rectangle.left() * scale)), int(round(rectangle.top() * scale)),
+                          int(round(rectangle.right() * scale)), int(round(rectangle.bottom() * scale)))
+
+def detectFaces(grayscale_image, models=None, upsample=1, scales=None):
+    # Function to get array of rectangles surrounding faces detected
+    # scales: detection scale pyramid (e.g. pyramidScales(...)), faces are detected on downscaled copies,
+    #         from the smallest scale up, until a face is found. Rectangles are returned in full resolution
+    # grayscale_image may be an ImageContext: its grayscale image & pyramid levels are reused
+    if models is None:
+        models = getModels()
+    context = asContext(grayscale_image)
+    # Load the detector & convert to grayscale before the 'detection' timer (timed as their own stages)
+    detector = models.detector
+    context.gray
+    with getProfiler().stage('detection'):
+        return _detectFaces(detector, context, upsample, scales)
+
+def _detectFaces(detector, context, upsample, scales):
+    if not scales:
+        return detector(context.gray, upsample)
     
-    # array of rectangles surrounding faces detected
-    rectangles = detector(grayscale_image, 1)
+    for scale in sorted(scales):
+        if scale >= 1:
+            return detector(context.gray, upsample)
+        rectangles = detector(context.level(scale), upsample)
+        if len(rectangles) > 0:
+            return [scaleRectangle(rectangle, 1 / scale) for rectangle in rectangles]
+    return []
 
-    # If at least one face is detected   
-    if len(rectangles) > 0:
-        # Get 68 landmark points
-        faceLandmarks = predictor68(grayscale_image, rectangles[0])
-        faceLandmarks = face_utils.shape_to_np(faceLandmarks)
-        
+
+# Landmark modes of predictLandmarks:
+#    '68+81' -> points 0-67 from the 68 predictor (higher accuracy) + forehead points 68-80 from the 81 predictor
+#    '81'    -> all points from the 81 predictor (one shape predictor per face, faster)
+LANDMARK_MODES = ('68+81', '81')
+
+def requiredModels(landmarkMode='68+81'):
+    # Function to get the models used by a landmark mode (e.g. to load only those at worker start)
+    if landmarkMode not in LANDMARK_MODES:
+        raise ValueError('unknown landmark mode %r (expected one of %s)' % (landmarkMode, ', '.join(LANDMARK_MODES)))
+    return ('detector', 'predictor68', 'predictor81') if landmarkMode == '68+81' else ('detector', 'predictor81')
+
+
+def shapeToArray(shape):
+    # Function to convert a dlib shape (predictor output) to an int array of shape (num_parts, 2)
+    coords = np.zeros((shape.num_parts, 2), dtype=int)
+    for i in range(shape.num_parts):
+        point = shape.part(i)
+        coords[i] = (point.x, point.y)
+    return coords
+
+
+def predict68(grayscale_image, rectangle, models=None):
+    # Function to predict the 68 landmarks points of the face inside rectangle
+    if models is None:
+        models = getModels()
+    predictor = models.predictor68
+    with getProfiler().stage('predictor68'):
+        faceLandmarks = predictor(grayscale_image, rectangle)
+    return shapeToArray(faceLandmarks)
+
+
+def predict81(grayscale_image, rectangle, models=None):
+    # Function to predict the 81 landmarks points of the face inside rectangle with the 81 predictor only
+    if models is None:
+        models = getModels()
+    predictor = models.predictor81
+    with getProfiler().stage('predictor81'):
+        faceLandmarks = predictor(grayscale_image, rectangle)
+    return shapeToArray(faceLandmarks)
+
+
+def predictLandmarks(grayscale_image, rectangle, models=None, eyeOnlyMode=False, landmarkMode='68+81'):
+    # Function to predict the raw 81 landmarks points of the face inside rectangle (no enhancement)
+    # landmarkMode: '68+81' (default, two predictors) or '81' (81 predictor only), see LANDMARK_MODES
+    if models is None:
+        models = getModels()
+    
+    if landmarkMode == '81':
+        fullFacePoints = predict81(grayscale_image, rectangle, models)
         if eyeOnlyMode:
-            # Return eye points to perform a calculated rotation
-            return np.array([faceLandmarks[39], faceLandmarks[42]])
-        
-        # Get 81 landmark points
-        foreheadLandmarks = predictor81(grayscale_image, rectangles[0])
-        foreheadLandmarks = face_utils.shape_to_np(foreheadLandmarks)
-        
-        # Get 68 point from -68- predictor (higher accuracy) + forehead from -81- predictor
-        fullFacePoints = np.concatenate((faceLandmarks, foreheadLandmarks[68:]))
+            return fullFacePoints[[39, 42]]
+        return fullFacePoints
+    if landmarkMode != '68+81':
+        raise ValueError('unknown landmark mode %r (expected one of %s)' % (landmarkMode, ', '.join(LANDMARK_MODES)))
+
+    # Get 68 landmark points
+    faceLandmarks = predict68(grayscale_image, rectangle, models)
+    
+    if eyeOnlyMode:
+        # Return eye points to perform a calculated rotation
+        return np.array([faceLandmarks[39], faceLandmarks[42]])
+    
+    # Get 81 landmark points
+    foreheadLandmarks = predict81(grayscale_image, rectangle, models)
+    
+    # Get 68 point from -68- predictor (higher accuracy) + forehead from -81- predictor
+    fullFacePoints = np.concatenate((faceLandmarks, foreheadLandmarks[68:]))
+    return fullFacePoints
+
+
+def enhanceLandmarks(grayscale_image, fullFacePoints, allowEnhancement=False, returnForeheadClarity=False):
+    # Function to improve the forehead points predicted by the 81 predictor (modifies fullFacePoints)
+    # returnForeheadClarity: also return if the forehead is clear (None when enhancement is not allowed)
+    with getProfiler().stage('enhancement'):
+        return _enhanceLandmarks(grayscale_image, fullFacePoints, allowEnhancement, returnForeheadClarity)
+
+def _enhanceLandmarks(grayscale_image, fullFacePoints, allowEnhancement, returnForeheadClarity):
+    
+    # Get forehead region & height to perform simple improvement
+    x,y,x2,y2 = (fullFacePoints[69,0]-10, fullFacePoints[68,1], fullFacePoints[80,0]+10, fullFacePoints[23, 1])
+    foreheadRegion = grayscale_image[y:y2,x:x2]
+    foreheadHeight = foreheadRegion.shape[0]
+    
+    if allowEnhancement:
+        # Perform progressive quality improvement
+        # Get nose region to get average skin color
+        x,y,x2,y2 = (fullFacePoints[28,0]-5, fullFacePoints[28,1], fullFacePoints[28,0]+5, fullFacePoints[30,1])
+        noseRegion = grayscale_image[y:y2, x:x2]
+        avgSkinColor = np.average(noseRegion[:,:])
         
-        # Get forehead region & height to perform simple improvement
-        x,y,x2,y2 = (fullFacePoints[69,0]-10, fullFacePoints[68,1], fullFacePoints[80,0]+10, fullFacePoints[23, 1])
-        foreheadRegion = grayscale_image[y:y2,x:x2]
-        foreheadHeight = foreheadRegion.shape[0]
+        # Check if forehead is clear -> perform heuristic based enhancement
+        forehead_is_clear = clearForehead(foreheadRegion, avgSkinColor)
+        originalPoints = fullFacePoints[[69,70,71,73,80]]
         
-        if allowEnhancement:
-            # Perform progressive quality improvement
-            # Get nose region to get average skin color
-            x,y,x2,y2 = (fullFacePoints[28,0]-5, fullFacePoints[28,1], fullFacePoints[28,0]+5, fullFacePoints[30,1])
-            noseRegion = grayscale_image[y:y2, x:x2]
-            avgSkinColor = np.average(noseRegion[:,:])
+        if forehead_is_clear:
+            avgSkinColor = np.average(foreheadRegion)
             
-            # Check if forehead is clear -> perform heuristic based enhancement
-            forehead_is_clear = clearForehead(foreheadRegion, avgSkinColor)
-            originalPoints = fullFacePoints[[69,70,71,73,80]]
+            # Modify some points for more accuracy
+            # Point[68] will be center between lower-lip & chin
+            distance = int((fullFacePoints[8,1]-fullFacePoints[57,1]) / 2)
+            fullFacePoints[68] = np.array([fullFacePoints[8,0], fullFacePoints[8,1]-distance])
+            
+            # Enhance points locations
+            enhancedPoints = moveUpPoints(grayscale_image, originalPoints, avgSkinColor, foreheadHeight)
+
+            # Assign original points to enhanced points (some maybe the same)
+            fullFacePoints[[69,70,71,73,80]] = enhancedPoints  
+            
+            # Adjust points to fix any corruptions
+            fullFacePoints[[69,70,71,73,80]] = adjustPoints(enhancedPoints, fullFacePoints[76], fullFacePoints[79])
+
+            #Prepare point[72] for center of forehead
+            distance = (fullFacePoints[22,0] - fullFacePoints[21,0]) / 2
+            distanceY = (fullFacePoints[21,1] - fullFacePoints[71,1]) / 2
+            fullFacePoints[72] = np.array([fullFacePoints[21,0] + distance, fullFacePoints[21,1]-distanceY])
+            
+            # Point[74] sometimes have a fixed corruption, this line helps :)
+            fullFacePoints[74,0] -= foreheadHeight * 0.1 # Arbitery heurestic
             
-            if forehead_is_clear:
-                avgSkinColor = np.average(foreheadRegion)
-                
-                # Modify some points for more accuracy
-                # Point[68] will be center between lower-lip & chin
-                distance = int((fullFacePoints[8,1]-fullFacePoints[57,1]) / 2)
-                fullFacePoints[68] = np.array([fullFacePoints[8,0], fullFacePoints[8,1]-distance])
-                
-                # Enhance points locations
-                enhancedPoints = np.array([moveUp(grayscale_image, orgPoint, avgSkinColor, foreheadHeight) for orgPoint in originalPoints])
-
-                # Assign original points to enhanced points (some maybe the same)
-                fullFacePoints[[69,70,71,73,80]] = enhancedPoints  
-                
-                # Adjust points to fix any corruptions
-                fullFacePoints[[69,70,71,73,80]] = adjustPoints(enhancedPoints, fullFacePoints[76], fullFacePoints[79])
-
-                #Prepare point[72] for center of forehead
-                distance = (fullFacePoints[22,0] - fullFacePoints[21,0]) / 2
-                distanceY = (fullFacePoints[21,1] - fullFacePoints[71,1]) / 2
-                fullFacePoints[72] = np.array([fullFacePoints[21,0] + distance, fullFacePoints[21,1]-distanceY])
-                
-                # Point[74] sometimes have a fixed corruption, this line helps :)
-                fullFacePoints[74,0] -= foreheadHeight * 0.1 # Arbitery heurestic
-                
-            else:
-                # If forehead isn't clear -> fix points with very simple heuristics
-                fullFacePoints[70,1] -= foreheadHeight * 0.2
-                fullFacePoints[71,1] -= foreheadHeight * 0.3
-                fullFacePoints[80,1] -= foreheadHeight * 0.2
-    
         else:
-            # If Enhancement is False -> do the simple enhancement, better quality + low performance :)
+            # If forehead isn't clear -> fix points with very simple heuristics
             fullFacePoints[70,1] -= foreheadHeight * 0.2
             fullFacePoints[71,1] -= foreheadHeight * 0.3
             fullFacePoints[80,1] -= foreheadHeight * 0.2
-            pass
-        
-        return fullFacePoints
+
+    else:
+        # If Enhancement is False -> do the simple enhancement, better quality + low performance :)
+        fullFacePoints[70,1] -= foreheadHeight * 0.2
+        fullFacePoints[71,1] -= foreheadHeight * 0.3
+        fullFacePoints[80,1] -= foreheadHeight * 0.2
+        forehead_is_clear = None
+    
+    if returnForeheadClarity:
+        return fullFacePoints, forehead_is_clear
+    return fullFacePoints
+
+
+def facial_landmarks(image, eyeOnlyMode=False, allowEnhancement=False, models=None, detectionScales=None,
+                     landmarkMode='68+81', upsample=1):
+    # Function to perform facial landmark detection on the whole face
+    # models: FaceModels holder (process-wide registry is used if not given)
+    # detectionScales: scale pyramid to detect faces on downscaled copies (see pyramidScales), landmarks are
+    #                  always predicted on the full resolution image
+    # image may be an ImageContext: grayscale & pyramid levels computed by earlier calls are reused
+    # landmarkMode: '68+81' (default, higher accuracy) or '81' (81 predictor only, faster), see LANDMARK_MODES
+    # upsample: detector upsampling (1 finds faces >= 40 pixels, 0 faces >= 80 pixels only but is faster)
+
+    # Use dlib 68 & 81 to predict landmarks points coordinates (loaded once)
+    if models is None:
+        models = getModels()
+
+    # Grayscale image (computed once per image context)
+    context = asContext(image)
+    grayscale_image = context.gray
+    
+    # array of rectangles surrounding faces detected
+    rectangles = detectFaces(context, models, upsample, detectionScales)
+
+    # If at least one face is detected   
+    if len(rectangles) > 0:
+        fullFacePoints = predictLandmarks(grayscale_image, rectangles[0], models, eyeOnlyMode, landmarkMode)
+        if eyeOnlyMode:
+            return fullFacePoints
+        return enhanceLandmarks(grayscale_image, fullFacePoints, allowEnhancement)
     # No faces found
     else:
         return None
 
 
+def facial_landmarks_all(image, allowEnhancement=False, models=None, upsample=1, detectionScales=None,
+                         landmarkMode='68+81'):
+    # Function to perform facial landmark detection on all faces of the image, with one detector pass
+    # Output: array of shape (n_faces, 81, 2) - (0, 81, 2) if no faces found
+    if models is None:
+        models = getModels()
+    context = asContext(image)
+    grayscale_image = context.gray
+    rectangles = detectFaces(context, models, upsample, detectionScales)
+    
+    allFacesPoints = np.zeros((len(rectangles), 81, 2), dtype=int)
+    for i, rectangle in enumerate(rectangles):
+        fullFacePoints = predictLandmarks(grayscale_image, rectangle, models, landmarkMode=landmarkMode)
+        allFacesPoints[i] = enhanceLandmarks(grayscale_image, fullFacePoints, allowEnhancement)
+    return allFacesPoints
+
+
 def adjustPoints(points, leftSidePoint, rightSidePoint):
     # Function to adjust landmarks points of the forehead & fix corruptions of improvement
     
@@ -212,22 +390,67 @@ def adjustPoints(points, leftSidePoint, rightSidePoint):
         
     return points
 
-def align_face(image, eyePoints):
-  # Function to rotate image to align the face
-  # Get left eye & right eye coordinates
+def alignmentAngle(eyePoints):
+  # Function to calculate the angle (degrees) of the line between the eyes
   leftEyeX,leftEyeY = eyePoints[0]
   rightEyeX, rightEyeY = eyePoints[1]
-  
-  # Calculate angle of rotation & origin point
   angle = math.atan( (leftEyeY - rightEyeY) / (leftEyeX - rightEyeX) ) * (180/math.pi)
+  return angle
+
+def alignmentMatrix(image, eyePoints):
+  # Function to get the rotation matrix (2x3) used by align_face
+  # Calculate angle of rotation & origin point
+  angle = alignmentAngle(eyePoints)
   origin_point = tuple(np.array(image.shape[1::-1]) / 2)
+  rot_mat = cv2.getRotationMatrix2D(origin_point, angle, 1.0)
+  return rot_mat
+
+def align_face(image, eyePoints, returnMatrix=False):
+  # Function to rotate image to align the face
+  # image may be an ImageContext: the result is then the (cached) aligned ImageContext
+  # Get left eye & right eye coordinates -> rotation matrix
+  rot_mat = alignmentMatrix(image, eyePoints)
   
   # Rotate using rotation matrix
-  rot_mat = cv2.getRotationMatrix2D(origin_point, angle, 1.0)
-  result = cv2.warpAffine(image, rot_mat, image.shape[1::-1], flags=cv2.INTER_LINEAR)
+  if isinstance(image, ImageContext):
+      result = image.warp(rot_mat)
+  else:
+      with getProfiler().stage('align'):
+          result = cv2.warpAffine(image, rot_mat, image.shape[1::-1], flags=cv2.INTER_LINEAR)
+  if returnMatrix:
+      return result, rot_mat
   return result
 
 
+def align_face_roi(image, eyePoints, faceBox, padding=0.3):
+  # Function to rotate only the face region (fast alignment for large images with a small face)
+  # Rotation is done around the eyes midpoint & only a padded face region (ROI) is warped
+  # Input:
+  #    faceBox: (x, y, x2, y2) of the face in image
+  #    padding: proportion of the face width/height added on each side of the ROI
+  # Output:
+  #    aligned ROI image, affine matrix (2x3) mapping image coordinates -> ROI coordinates
+  #    (use geometry.invertAffine to map landmarks / boxes back to image coordinates)
+  #    image may be an ImageContext: the ROI is then the (cached) aligned ImageContext
+  angle = alignmentAngle(eyePoints)
+  eyesCenter = tuple(np.mean(np.asarray(eyePoints, dtype=np.float64), axis=0))
+  rot_mat = cv2.getRotationMatrix2D(eyesCenter, angle, 1.0)
+  
+  # ROI (in rotated coordinates) centered on the rotated face center
+  x, y, x2, y2 = faceBox
+  width = int(round((x2 - x) * (1 + 2 * padding)))
+  height = int(round((y2 - y) * (1 + 2 * padding)))
+  centerX, centerY = transformPoints([[(x + x2) / 2, (y + y2) / 2]], rot_mat)[0]
+  rot_mat[0, 2] -= centerX - width / 2
+  rot_mat[1, 2] -= centerY - height / 2
+  
+  if isinstance(image, ImageContext):
+      result = image.warp(rot_mat, (width, height))
+  else:
+      with getProfiler().stage('align'):
+          result = cv2.warpAffine(image, rot_mat, (width, height), flags=cv2.INTER_LINEAR)
+  return result, rot_mat
+
 def cropFullFace(image, points, padding = True, xProportion = 0.025, yProportion = 0.025):
     # Function to extract the face part of the image
     
@@ -252,23 +475,11 @@ def cropFullFace(image, points, padding = True, xProportion = 0.025, yProportion
     return cropped
 
 
-def delaunayOnPlane(facial_points):
-    # Function to visualize delaunay triangulation on matplotlib
-    tri = Delaunay(facial_points)
-    rot = transforms.Affine2D().rotate_deg(180)
-    base = plt.gca().transData
-    plt.gca().invert_xaxis()
-    plt.triplot(facial_points[:,0], facial_points[:,1], tri.simplices.copy(), transform=rot+base)
-    plt.plot(facial_points[:,0], facial_points[:,1], 'o', transform=rot+base)
-    plt.show()
-    
-
-def drawPoints(image, points, pointColor=(255,255,255), lineColor=(255,255,255), pointThickness=6, lineThickness=1):
-    # Function to draw points on facial features
-    for i in points:
-        x,y = i
-        image = cv2.circle(image, (x,y), radius=0, color=pointColor, thickness=pointThickness)
-
-    return image
-
-
+def __getattr__(name):
+    # Visualization helpers moved to visualization.py (imported on first use, keeps matplotlib & scipy out of
+    # the compute path). Only attribute access (detection.drawPoints) finds them: `from detection import *`
+    # doesn't, import them from visualization instead
+    if name in ('delaunayOnPlane', 'drawPoints'):
+        import visualization
+        return getattr(visualization, name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
@@ -0,0 +1,79 @@
+import os
+import shutil
+import numpy as np
+from extractor import FEATURE_NAMES, featureBoxes
+
+
+# Files of an exported dataset
+LANDMARKS_FILE = 'landmarks.npy'
+BOXES_FILE = 'boxes.npy'
+METADATA_FILE = 'metadata.parquet'
+
+
+def _finalizeArray(rawPath, npyPath, dtype, shape):
+    # Function to turn a raw (appended) binary file into a .npy file without loading it in memory
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': shape}
+    with open(npyPath, 'wb') as output, open(rawPath, 'rb') as raw:
+        np.lib.format.write_array_header_1_0(output, header)
+        shutil.copyfileobj(raw, output, 16 * 1024 * 1024)
+    os.remove(rawPath)
+
+
+class DatasetWriter:
+    # Columnar landmarks dataset writer:
+    #    landmarks.npy    -> (N, 81, 2) int16, memory-mappable
+    #    boxes.npy        -> (N, 16, 4) int32, crop rectangles of FEATURE_NAMES (x, y, x2, y2)
+    #    metadata.parquet -> file, face box, alignment angle & forehead clarity of each row
+    # Rows are appended to raw files while processing (memory doesn't grow), .npy headers are written on close
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.count = 0
+        self._landmarks = open(os.path.join(folder, LANDMARKS_FILE + '.raw'), 'wb')
+        self._boxes = open(os.path.join(folder, BOXES_FILE + '.raw'), 'wb')
+        self._columns = {'file': [], 'face_left': [], 'face_top': [], 'face_right': [], 'face_bottom': [],
+                         'angle': [], 'forehead_clear': []}
+
+    def add(self, filename, result):
+        # Function to append the pipeline result (FacePipeline.process) of an image
+        landmarks = np.asarray(result['landmarks'])
+        self._landmarks.write(landmarks.astype(np.int16).tobytes())
+        self._boxes.write(featureBoxes(landmarks, FEATURE_NAMES).astype(np.int32).tobytes())
+        faceBox = result.get('face_box', (-1, -1, -1, -1))
+        foreheadClear = result.get('forehead_clear')
+        self._columns['file'].append(filename)
+        for name, value in zip(('face_left', 'face_top', 'face_right', 'face_bottom'), faceBox):
+            self._columns[name].append(int(value))
+        self._columns['angle'].append(float(result.get('angle', np.nan)))
+        # Nullable boolean: None when enhancement (& the clarity check) was off
+        self._columns['forehead_clear'].append(foreheadClear)
+        self.count += 1
+
+    def close(self):
+        # Function to write the final .npy & parquet files
+        self._landmarks.close()
+        self._boxes.close()
+        _finalizeArray(self._landmarks.name, os.path.join(self.folder, LANDMARKS_FILE), np.int16, (self.count, 81, 2))
+        _finalizeArray(self._boxes.name, os.path.join(self.folder, BOXES_FILE), np.int32,
+                       (self.count, len(FEATURE_NAMES), 4))
+        import pandas as pd  # only needed to write the metadata (keeps pandas out of workers start)
+        metadata = pd.DataFrame(self._columns)
+        metadata['forehead_clear'] = metadata['forehead_clear'].astype('boolean')
+        metadata.to_parquet(os.path.join(self.folder, METADATA_FILE), index=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+def load_dataset(folder, mmap_mode='r'):
+    # Function to open an exported dataset, arrays are memory-mapped (nothing is read until used)
+    # Output: landmarks (N, 81, 2), boxes (N, 16, 4), metadata DataFrame
+    landmarks = np.load(os.path.join(folder, LANDMARKS_FILE), mmap_mode=mmap_mode)
+    boxes = np.load(os.path.join(folder, BOXES_FILE), mmap_mode=mmap_mode)
+    import pandas as pd
+    metadata = pd.read_parquet(os.path.join(folder, METADATA_FILE))
+    return landmarks, boxes, metadata
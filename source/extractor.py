@@ -1,6 +1,8 @@
+from collections.abc import Mapping
+import cv2
 import numpy as np
-import pandas as pd
 from geometry import *
+from profiling import getProfiler
 
 def collectFaceComponents(facial_points):
     # Function to collect landmarks points, grouped, as polygons\shapes
@@ -26,265 +28,319 @@ def collectFaceComponents(facial_points):
             }
     return faceComponents
 
+# Names of the features, in extraction order
+FEATURE_NAMES = ['forehead', 'left_eyebrow', 'right_eyebrow', 'left_eye', 'right_eye',
+                 'both_eyebrow', 'both_eye', 'left_eye_eyebrow', 'right_eye_eyebrow',
+                 'both_eye_eyebrow', 'clear_eyebrow', 'clear_eye', 'clear_eye_eyebrow',
+                 'nose', 'mouth', 'eye_nose_mouth_eyebrow']
+
+# Indexes (81 landmarks) of the face shape polygon (see collectFaceComponents)
+FACE_SHAPE_INDEXES = list(range(17)) + [78,74,79,73,80,71,70,69,76,75,77,0]
+
+# Crop rectangle of each feature -> (x, y, x2, y2), every coordinate is an anchor computed by featureAnchors
+FEATURE_BOXES = {
+        # face shape left/top/right, clear eyebrow top landmark
+        'forehead': ('face_left', 'face_top', 'face_right', 'clear_brow_top'),
+        # between left eyebrow and left side faceshape landmark [index 0 of 81], nose top landmark (between eyebrows)
+        # top eyebrow landmark, bottom eyebrow landmark
+        'left_eyebrow': ('left_brow_x', 'left_brow_top', 'nose_top_x', 'left_brow_bottom'),
+        # nose top landmark, between right eyebrow and right side faceshape landmark [index 16 of 81]
+        'right_eyebrow': ('nose_top_x', 'right_brow_top', 'right_brow_x2', 'right_brow_bottom'),
+        # between left eye and left side faceshape landmark, top landmark of nose
+        # between eye top landmark & eyebrow top landmark, second top nose landmark
+        'left_eye': ('left_eye_x', 'left_eye_y', 'nose_top_x', 'nose_second_y'),
+        # top landmark of nose, between right eye and right side faceshape landmark
+        'right_eye': ('nose_top_x', 'right_eye_y', 'right_eye_x2', 'nose_second_y'),
+        # top/bottom landmark of left/right eyebrow (maximum top/bottom is selected)
+        'both_eyebrow': ('left_brow_x', 'brows_top', 'right_brow_x2', 'brows_bottom'),
+        # y = between clear eyebrow & clear eye
+        'both_eye': ('left_eye_x', 'clear_eye_y', 'right_eye_x2', 'nose_second_y'),
+        'left_eye_eyebrow': ('left_brow_x', 'left_brow_top', 'nose_top_x', 'nose_second_y'),
+        'right_eye_eyebrow': ('nose_top_x', 'right_brow_top', 'right_brow_x2', 'nose_second_y'),
+        'both_eye_eyebrow': ('left_brow_x', 'brows_top', 'right_brow_x2', 'nose_second_y'),
+        # x, x2 = left face side & nose top landmark OR nose top landmark & right face side (clearer side)
+        'clear_eyebrow': ('clear_brow_x', 'clear_brow_top', 'clear_brow_x2', 'clear_brow_bottom'),
+        'clear_eye': ('clear_eye_x', 'clear_eye_y', 'clear_eye_x2', 'nose_second_y'),
+        'clear_eye_eyebrow': ('clear_brow_x', 'clear_brow_top', 'clear_brow_x2', 'nose_second_y'),
+        # x = the most right landmark of left eye || nose bottom landmark if it's more left
+        # x2 = the most left landmark of right eye || nose bottom landmark if it's more right
+        # y = average point on Y-axis of eyebrow, y2 = upper lip top landmark
+        'nose': ('nose_x', 'nose_y', 'nose_x2', 'upper_lip_top'),
+        # left cheek [index 5 of 81], nose bottom landmark, right cheek [index 11 of 81]
+        # point between chin bottom landmark and lower lip [index 68 of 81]
+        'mouth': ('left_cheek_x', 'nose_bottom_y', 'right_cheek_x', 'chin_lip_y'),
+        'eye_nose_mouth_eyebrow': ('left_brow_x', 'brows_top', 'right_brow_x2', 'chin_lip_y')
+        }
+
+ANCHOR_NAMES = sorted(set(anchor for box in FEATURE_BOXES.values() for anchor in box))
+FEATURE_BOX_INDEXES = np.array([[ANCHOR_NAMES.index(anchor) for anchor in FEATURE_BOXES[name]] for name in FEATURE_NAMES])
+
+
+def _middle(a, b):
+    # Same as int((a + b) / 2) for arrays
+    return np.trunc((a + b) / 2).astype(int)
+
+def clearLeftSide(points):
+    # Function to detect the clear face side (Better capture for eye+brows) of faces of shape (n_faces, 81, 2)
+    # distance between nose bottom-point & eyes angle-point 
+    lefteyeside = points[:, 39, 0]
+    righteyeside = points[:, 42, 0]
+    noseTip = points[:, 30, 0]
+    # Slightly looking to right or left -> decide which side is clearer
+    nose_eye_diff = np.abs(noseTip - lefteyeside) - np.abs(noseTip - righteyeside)
+    # (in your perspective), looking to right direction -> Left eye is clear, looking to left direction -> right eye is clear
+    return np.where(righteyeside - noseTip < 0, True,
+                    np.where(noseTip - lefteyeside < 0, False, nose_eye_diff > 1))
+
+# Formula of each anchor (& of the intermediate values they share), a -> FeatureAnchors of the faces
+ANCHOR_FORMULAS = {
+        'face_left': lambda a: a.x[:, FACE_SHAPE_INDEXES].min(axis=1),
+        'face_top': lambda a: a.y[:, FACE_SHAPE_INDEXES].min(axis=1),
+        'face_right': lambda a: a.x[:, FACE_SHAPE_INDEXES].max(axis=1),
+        'left_brow_x': lambda a: _middle(a.x[:, 17], a.x[:, 0]),
+        'right_brow_x2': lambda a: _middle(a.x[:, 26], a.x[:, 16]),
+        'left_eye_x': lambda a: _middle(a.x[:, 36], a.x[:, 0]),
+        'right_eye_x2': lambda a: _middle(a.x[:, 46], a.x[:, 16]),
+        'nose_top_x': lambda a: a.x[:, 27],
+        'nose_second_y': lambda a: a.y[:, 28],
+        'left_brow_top': lambda a: a.y[:, 17:22].min(axis=1),
+        'left_brow_bottom': lambda a: a.y[:, 17:22].max(axis=1),
+        'right_brow_top': lambda a: a.y[:, 22:27].min(axis=1),
+        'right_brow_bottom': lambda a: a.y[:, 22:27].max(axis=1),
+        'left_eye_top': lambda a: a.y[:, 36:42].min(axis=1),
+        'right_eye_top': lambda a: a.y[:, 42:47].min(axis=1),
+        'brows_top': lambda a: np.minimum(a['left_brow_top'], a['right_brow_top']),
+        'brows_bottom': lambda a: np.maximum(a['left_brow_bottom'], a['right_brow_bottom']),
+        'clear_brow_top': lambda a: a.clearSide('left_brow_top', 'right_brow_top'),
+        'clear_brow_bottom': lambda a: a.clearSide('left_brow_bottom', 'right_brow_bottom'),
+        'clear_eye_top': lambda a: a.clearSide('left_eye_top', 'right_eye_top'),
+        'left_eye_y': lambda a: _middle(a['left_brow_top'], a['left_eye_top']),
+        'right_eye_y': lambda a: _middle(a['right_brow_top'], a['right_eye_top']),
+        'clear_eye_y': lambda a: _middle(a['clear_brow_top'], a['clear_eye_top']),
+        'clear_brow_x': lambda a: a.clearSide('left_brow_x', 'nose_top_x'),
+        'clear_brow_x2': lambda a: a.clearSide('nose_top_x', 'right_brow_x2'),
+        'clear_eye_x': lambda a: a.clearSide('left_eye_x', 'nose_top_x'),
+        'clear_eye_x2': lambda a: a.clearSide('nose_top_x', 'right_eye_x2'),
+        'nose_x': lambda a: np.minimum(a.x[:, 39], a.x[:, 31]),
+        'nose_x2': lambda a: np.maximum(a.x[:, 42], a.x[:, 35]),
+        'nose_y': lambda a: np.trunc(np.where(a.clearLeft, a.y[:, 17:22].mean(axis=1),
+                                              a.y[:, 22:27].mean(axis=1))).astype(int),
+        'upper_lip_top': lambda a: a.y[:, 52],
+        'left_cheek_x': lambda a: a.x[:, 5],
+        'right_cheek_x': lambda a: a.x[:, 11],
+        'nose_bottom_y': lambda a: a.y[:, 33],
+        'chin_lip_y': lambda a: a.y[:, 8] - np.trunc((a.y[:, 8] - a.y[:, 57]) / 2).astype(int)
+        }
+
+
+class FeatureAnchors:
+    # Anchors of faces of shape (n_faces, 81, 2), each one is computed on first access & memoized
+    # (the clear side decision is computed once, only if an anchor needs it)
+
+    def __init__(self, points):
+        self.points = points
+        self.x, self.y = points[:, :, 0], points[:, :, 1]
+        self._values = {}
+        self._clearLeft = None
+
+    @property
+    def clearLeft(self):
+        if self._clearLeft is None:
+            self._clearLeft = clearLeftSide(self.points)
+        return self._clearLeft
+
+    def clearSide(self, left, right):
+        # Function to select the anchor of the clear side (left if the left side is clear, else right)
+        return np.where(self.clearLeft, self[left], self[right])
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            self._values[name] = ANCHOR_FORMULAS[name](self)
+        return self._values[name]
+
+    def stack(self, names):
+        # Function to get the anchors as an int array of shape (n_faces, len(names))
+        return np.stack([self[name] for name in names], axis=1).astype(int)
+
+
+def featureAnchors(points):
+    # Function to compute every coordinate used by the crop rectangles, for faces of shape (n_faces, 81, 2)
+    # Output: array of shape (n_faces, len(ANCHOR_NAMES))
+    return FeatureAnchors(points).stack(ANCHOR_NAMES)
+
+def resolveFeatureNames(options):
+    # Function to get the names of the features to extract (in extraction order), 'all' means every feature
+    options = set(options)
+    if 'all' in options:
+        return list(FEATURE_NAMES)
+    return [name for name in FEATURE_NAMES if name in options]
+
+def featureBoxes(landmarks_points, options=('all',)):
+    # Function to compute the crop rectangles of the features, in one pass
+    # Input:
+    #    landmarks coordinates of the 81 landmark dlib, shape (81, 2) or (n_faces, 81, 2)
+    #    options: array of strings, the features names (or 'all')
+    
+    # Output:
+    #    int array of (x, y, x2, y2) rectangles, shape (n_features, 4) or (n_faces, n_features, 4)
+    points = np.asarray(landmarks_points)
+    singleFace = points.ndim == 2
+    if singleFace:
+        points = points[np.newaxis]
+    names = resolveFeatureNames(options)
+    if len(names) == len(FEATURE_NAMES):
+        boxes = featureAnchors(points)[:, FEATURE_BOX_INDEXES]
+    else:
+        # Only the anchors of the requested features are computed
+        anchorNames = sorted(set(anchor for name in names for anchor in FEATURE_BOXES[name]))
+        indexes = [[anchorNames.index(anchor) for anchor in FEATURE_BOXES[name]] for name in names]
+        boxes = FeatureAnchors(points).stack(anchorNames)[:, np.array(indexes).reshape(-1, 4)]
+    return boxes[0] if singleFace else boxes
+
 def face_parts_imgs(image, landmarks_points, options):
    # Facial feature extraction
    # Input:
    #    Image to process
    #    landmarks coordinates of the 81 landmark dlib
    #    options: array of strings, the features to be extracted
-   #            mentioned below
+   #            mentioned in FEATURE_NAMES (or 'all')
    
    # Output:
    #    dictionary, {'feature_name': array(image)}
    
-   
-    # Get & Initialize face components
-    faceComponents = collectFaceComponents(landmarks_points)
-    face_shape = faceComponents["face_shape"]
-    leftEye, rightEye = faceComponents["left_eye"], faceComponents["right_eye"]
-    left_ibrow, right_ibrow = faceComponents["left_i_brow"], faceComponents["right_i_brow"]
-    nose_line, nose_arc = faceComponents["nose_line"], faceComponents["nose_arc"]
-    upper_lip = faceComponents["upper_lip"]
-    
-    if 'all' in options:
-        options.extend(['forehead', 'left_eyebrow', 'right_eyebrow',
-                        'both_eyebrow', 'clear_eyebrow', 'left_eye',
-                        'right_eye', 'both_eye', 'clear_eye',
-                        'left_eye_eyebrow', 'right_eye_eyebrow',
-                        'both_eye_eyebrow', 'clear_eye_eyebrow',
-                        'nose', 'mouth', 'eye_nose_mouth_eyebrow'
-                        ])
-    
-    # Initialize response
-    features = {}
-    
-    # Detect the clear face side (Better capture for eye+brows))
-    # distance between nose bottom-point & eyes angle-point 
-    lefteyeside = leftEye[3]
-    righteyeside = rightEye[0]
-    noseTip = nose_line[nose_line.shape[0]-1]
-    if righteyeside[0] - noseTip[0] < 0: 
-        # (in your perspective), person is looking to right direction -> so Left eye is clear
-        clear_eye = leftEye
-        clear_ibrow = left_ibrow
-        clearer_left_side = True
-    elif noseTip[0] - lefteyeside[0] < 0:
-        # Person is looking to left direction -> so right eye is clear
-        clear_eye = rightEye
-        clear_ibrow = right_ibrow
-        clearer_left_side = False
-    else:
-        # Decide which side is clearer (person is slightly looking to right or left)
-        nose_eye_diff = abs(noseTip[0]-lefteyeside[0]) - abs(noseTip[0]-righteyeside[0])
-        ibrow_position = "right" if nose_eye_diff <= 1 else "left"
-        clear_eye = faceComponents[ibrow_position+"_eye"]
-        clear_ibrow = faceComponents[ibrow_position+"_i_brow"]
-        clearer_left_side = True if ibrow_position == 'left' else False
-        
-    ##### Forehead #####
-    if 'forehead' in options:
-        x, y, x2, y2 = np.min(face_shape[:, 0]), np.min(face_shape[:, 1]), np.max(face_shape[:, 0]), np.min(clear_ibrow[:, 1])
-        forehead_img = image[y:y2, x:x2] # Best resolution (224, 64)
-        features['forehead'] = forehead_img
-        
-    
-    ##### Left eyebrow #####
-    if 'left_eyebrow' in options:
-        # x = between left eyebrow and left side faceshape landmark [index 0 of 81]
-        # x2 = nose top landmark (between eyebrows)
-        # y = top eyebrow landmark,   y2 = bottom eyebrow landmark
-        x = int((left_ibrow[0, 0] + face_shape[0, 0]) / 2)
-        x2 =  nose_line[0, 0]
-        y, y2 = np.min(left_ibrow[:, 1]), np.max(left_ibrow[:, 1])
-        left_ibrow_img = image[y:y2, x:x2]
-        features['left_eyebrow'] = left_ibrow_img
-    
-    ##### Right eyebrow #####
-    if 'right_eyebrow' in options:
-        # x =  nose top landmark (between eyebrows)
-        # x2 = between right eyebrow and right side faceshape landmark [index 16 of 81]
-        # y = top eyebrow landmark,   y2 = bottom eyebrow landmark
-        # y2 = eyebrow bottom landmark
-        x = nose_line[0,0]
-        x2 = int((right_ibrow[4, 0] + face_shape[16, 0]) / 2)
-        y, y2 = np.min(right_ibrow[:, 1]), np.max(right_ibrow[:, 1])  
-        right_ibrow_img = image[y:y2, x:x2]
-        features['right_eyebrow'] = right_ibrow_img
-    
-    
-    ##### Left eye #####
-    if 'left_eye' in options:
-        # x = between left eye and left side faceshape landmark [index 0 of 81]
-        # x2 = top landmark of nose (between eyes)
-        # y = between eye top landmark & eyebrow top landmark
-        # y2 = second top nose landmark
-        x = int((leftEye[0, 0] + face_shape[0, 0]) / 2)
-        x2 = nose_line[0, 0]
-        y = int((np.min(left_ibrow[:, 1]) + np.min(leftEye[:, 1])) / 2)
-        y2 = nose_line[1, 1]
-        leftEye_img = image[y:y2, x:x2]
-        features['left_eye'] = leftEye_img
-    
-    ##### Right eye #####
-    if 'right_eye' in options:
-        # x = top landmark of nose (between eyes)
-        # x2 = between right eye and right side faceshape landmark [index 16 of 81]
-        # y = between eye top landmark & eyebrow top landmark
-        # y2 = second top nose landmark
-        x = nose_line[0, 0]
-        x2 = int((rightEye[4, 0] + face_shape[16, 0]) / 2)
-        y = int((np.min(right_ibrow[:, 1]) + np.min(rightEye[:, 1])) / 2)
-        y2 = nose_line[1, 1]
-        rightEye_img = image[y:y2, x:x2]
-        features['right_eye'] = rightEye_img
-    
-    ##### Both eyebrows #####
-    if 'both_eyebrow' in options:
-        # x = between left eyebrow and left side faceshape landmark [index 0 of 81]
-        # x2 = between right eyebrow and right side faceshape landmark [index 16 of 81]
-        # y = top landmark of left/right eyebrow (maximum top is selected)
-        # y2 = bottom landmark of left/right eyebrow (maximum bottom is selected)
-        x = int((left_ibrow[0, 0] + face_shape[0, 0]) / 2)
-        x2 = int((right_ibrow[4, 0] + face_shape[16, 0]) / 2)
-        y = min(np.min(left_ibrow[:, 1]), np.min(right_ibrow[:, 1]))
-        y2 = max(np.max(left_ibrow[:, 1]), np.max(right_ibrow[:, 1]))
-        both_eyebrows_img = image[y:y2, x:x2]
-        features['both_eyebrow'] = both_eyebrows_img
-    
-    ##### Both eyes #####
-    if 'both_eye' in options:
-        # x = between left eye and left side faceshape landmark [index 0 of 81]
-        # x2 = between right eye and right side faceshape landmark [index 16 of 81]
-        # y = between clear eyebrow & clear eye
-        # y2 = second top nose landmark
-        x = int((leftEye[0, 0] + face_shape[0, 0]) / 2)
-        x2 = int((rightEye[4, 0] + face_shape[16, 0]) / 2)
-        y = int((np.min(clear_ibrow[:, 1]) + np.min(clear_eye[:, 1])) / 2)
-        y2 = nose_line[1, 1]
-        both_eyes_img = image[y:y2, x:x2]
-        features['both_eye'] = both_eyes_img
-    
-    ##### Eye and Eyebrow LEFT #####
-    if 'left_eye_eyebrow' in options:
-        # x = between left eyebrow and left side faceshape landmark [index 0 of 81]
-        # x2 = nose top landmark (between eyebrows)
-        # y = top left eyebrow landmark
-        # y2 = second top nose landmark
-        x = int((left_ibrow[0, 0] + face_shape[0, 0]) / 2)
-        x2 =  nose_line[0, 0]
-        y = np.min(left_ibrow[:, 1])
-        y2 = nose_line[1, 1]
-        eye_eyebrow_left =  image[y:y2, x:x2]
-        features['left_eye_eyebrow'] = eye_eyebrow_left
-    
-    ##### Eye and Eyebrow RIGHT #####
-    if 'right_eye_eyebrow' in options:
-        # x = top landmark of nose (between eyes)
-        # x2 = between right eyebrow and right side faceshape landmark [index 16 of 81]
-        # y = top right eyebrow landmark
-        # y2 = second top nose landmark
-        x = nose_line[0, 0]
-        x2 = int((right_ibrow[4, 0] + face_shape[16, 0]) / 2)
-        y = np.min(right_ibrow[:, 1])
-        y2 = nose_line[1, 1]
-        eye_eyebrow_right = image[y:y2, x:x2]
-        features['right_eye_eyebrow'] = eye_eyebrow_right
-    
-    ##### Eye and Eyebrow LEFT & RIGHT #####
-    if 'both_eye_eyebrow' in options:
-        # x = between left eyebrow and left side faceshape landmark [index 0 of 81]
-        # x2 = between right eyebrow and right side faceshape landmark [index 16 of 81]
-        # y = top eyebrow landmark
-        # y2 = second top nose landmark
-        x = int((left_ibrow[0, 0] + face_shape[0, 0]) / 2)
-        x2 = int((right_ibrow[4, 0] + face_shape[16, 0]) / 2)
-        y = min(np.min(left_ibrow[:, 1]), np.min(right_ibrow[:, 1]))
-        y2 = nose_line[1, 1]
-        eye_eyebrow_all = image[y:y2, x:x2]
-        features['both_eye_eyebrow'] = eye_eyebrow_all
-    
-    
-    ##### Clear Eyebrow #####
-    if 'clear_eyebrow' in options:
-        # x =  left face side OR nose top landmark (between eyebrows)
-        # x2 = between clearer eyebrow and clearer side faceshape landmark [index 16 of 81]
-        # y = top eyebrow landmark
-        # y2 = eyebrow bottom landmark
-        x = int((left_ibrow[0, 0] + face_shape[0, 0]) / 2) if clearer_left_side else nose_line[0,0]
-        x2 = nose_line[0,0] if clearer_left_side else int((right_ibrow[4, 0] + face_shape[16, 0]) / 2)
-        y, y2 = np.min(clear_ibrow[:, 1]), np.max(clear_ibrow[:, 1])  
-        clear_ibrow_img = image[y:y2, x:x2]
-        features['clear_eyebrow'] = clear_ibrow_img
-    
-    
-    ##### Clear Eye #####
-    if 'clear_eye' in options:
-        # x = leftEye.x OR rightEye.x
-        # x2 = leftEye.x2 OR rightEye.x2
-        # y = between clear eyebrow and clear eye
-        # y2 = second top nose landmark
-        x = int((leftEye[0, 0] + face_shape[0, 0]) / 2) if clearer_left_side else nose_line[0, 0]
-        x2 = nose_line[0, 0] if clearer_left_side else int((rightEye[4, 0] + face_shape[16, 0]) / 2)
-        y = int((np.min(clear_ibrow[:, 1]) + np.min(clear_eye[:, 1])) / 2)
-        y2 = nose_line[1,1]
-        clear_eye_img = image[y:y2, x:x2]
-        features['clear_eye'] = clear_eye_img
-        
-    
-    ##### Clear Eye and Eyebrow #####
-    if 'clear_eye_eyebrow' in options:
-        # x =  left face side OR nose top landmark (between eyebrows)
-        # x2 = between clearer eyebrow and clearer side faceshape landmark [index 16 of 81]
-        # y = top eyebrow landmark
-        # y2 = second top nose landmark
-        x = int((left_ibrow[0, 0] + face_shape[0, 0]) / 2) if clearer_left_side else nose_line[0,0]
-        x2 = nose_line[0,0] if clearer_left_side else int((right_ibrow[4, 0] + face_shape[16, 0]) / 2)
-        y = np.min(clear_ibrow[:, 1])
-        y2 = nose_line[1,1]
-        clear_eye_eyebrow = image[y:y2, x:x2]
-        features['clear_eye_eyebrow'] = clear_eye_eyebrow
-        
-    
-    ##### Nose #####
-    if 'nose' in options:
-        # x = the most right landmark of left eye || nose bottom landmark if it's more left
-        # x2 = the most left landmark of right eye|| nose bottom landmark if it's more right
-        # y = average point on Y-axis of eyebrow
-        # y2 = upper lip top landmark
-        x = min(leftEye[3,0], nose_arc[0, 0])
-        x2 = max(rightEye[0,0], nose_arc[4, 0])
-        y = int(np.average(clear_ibrow[:, 1]))
-        y2 = upper_lip[2, 1]
-        nose = image[y:y2, x:x2]
-        features['nose'] = nose
-        
-
-    ##### Mouth #####
-    if 'mouth' in options:
-        # x = left cheek [index 5 of 81]
-        # x2 = right cheek [index 11 of 81]
-        # y = nose bottom landmark
-        # y2 = point between chin bottom landmark and lower lip [index 68 of 81]
-        x = face_shape[5,0]
-        x2 = face_shape[11,0]
-        y = nose_arc[2, 1]
-        y2 = landmarks_points[8,1] - int((landmarks_points[8,1]-landmarks_points[57,1]) / 2)
-        mouth = image[y:y2, x:x2]
-        features['mouth'] = mouth
-    
-    ##### Eyebrow Eye Nose Mouth ##### 
-    if 'eye_nose_mouth_eyebrow' in options:
-        # x = between left eyebrow and left side faceshape landmark [index 0 of 81]
-        # x2 = between right eyebrow and right side faceshape landmark [index 16 of 81]
-        # y = top eyebrow landmark
-        # y2 =point between chin bottom landmark and lower lip [index 68 of 81]
-        x = int((left_ibrow[0, 0] + face_shape[0, 0]) / 2)
-        x2 = int((right_ibrow[4, 0] + face_shape[16, 0]) / 2)
-        y = min(np.min(left_ibrow[:, 1]), np.min(right_ibrow[:, 1]))
-        y2 = landmarks_points[8,1] - int((landmarks_points[8,1]-landmarks_points[57,1]) / 2)
-        general_features = image[y:y2, x:x2]
-        features['eye_nose_mouth_eyebrow'] = general_features
-    
+    with getProfiler().stage('crop'):
+        names = resolveFeatureNames(options)
+        boxes = featureBoxes(landmarks_points, names)
+        features = {}
+        for name, (x, y, x2, y2) in zip(names, boxes):
+            features[name] = image[y:y2, x:x2]
     return features
 
-    
\ No newline at end of file
+
+def face_parts_imgs_batch(image, landmarks_batch, options):
+   # Facial feature extraction of many faces of the same image (e.g. output of facial_landmarks_all)
+   # Input:
+   #    Image to process
+   #    landmarks coordinates, array of shape (n_faces, 81, 2)
+   #    options: array of strings, the features to be extracted (same as face_parts_imgs)
+   
+   # Output:
+   #    list of dictionaries (one per face), {'feature_name': array(image)}
+   
+    with getProfiler().stage('crop'):
+        names = resolveFeatureNames(options)
+        allBoxes = featureBoxes(np.asarray(landmarks_batch).reshape(-1, 81, 2), names)
+        return [{name: image[y:y2, x:x2] for name, (x, y, x2, y2) in zip(names, boxes)} for boxes in allBoxes]
+
+
+class FeatureCrops:
+    # Zero-copy output of the feature extraction: crop rectangles + a shared reference to the image
+    # Nothing is copied until materialize() is called, views & encoded bytes are taken straight from the image
+
+    def __init__(self, image, names, boxes):
+        self.image = image
+        self.names = list(names)
+        self.boxes = np.asarray(boxes).reshape(-1, 4)
+        self._indexes = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self._indexes
+
+    def box(self, name):
+        # Function to get the (x, y, x2, y2) rectangle of a feature
+        return tuple(int(value) for value in self.boxes[self._indexes[name]])
+
+    def view(self, name):
+        # Function to get the feature image as a view of the shared image (no copy)
+        x, y, x2, y2 = self.boxes[self._indexes[name]]
+        return self.image[y:y2, x:x2]
+
+    def views(self, names=None):
+        return {name: self.view(name) for name in (names or self.names)}
+
+    def materialize(self, names=None):
+        # Function to copy the features images into their own contiguous buffers
+        return {name: np.ascontiguousarray(self.view(name)) for name in (names or self.names)}
+
+    def encode(self, names=None, ext='.jpg', params=None):
+        # Function to encode the features images (directly from the views), e.g. params=[cv2.IMWRITE_JPEG_QUALITY, 90]
+        # Output: dictionary {'feature_name': bytes}, empty crops are skipped
+        encoded = {}
+        for name in (names or self.names):
+            view = self.view(name)
+            if view.size == 0:
+                continue
+            ok, buffer = cv2.imencode(ext, view, params or [])
+            if ok:
+                encoded[name] = buffer.tobytes()
+        return encoded
+
+    def toDict(self):
+        # Function to describe the crops without pixels (e.g. to send over IPC)
+        return {name: self.box(name) for name in self.names}
+
+
+class FaceFeatures(Mapping):
+    # Lazy features of one face: {'feature_name': view of the image}, each region is computed on first access
+    # & memoized, anchors (& the clear side decision) are shared between features
+    # Mapping of the requested names only (options), view(name) gives any feature of FEATURE_NAMES
+
+    def __init__(self, image, landmarks_points, options=('all',)):
+        self.image = image
+        self.names = resolveFeatureNames(options)
+        self.anchors = FeatureAnchors(np.asarray(landmarks_points)[np.newaxis])
+        self._boxes = {}
+        self._views = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    @property
+    def clearLeft(self):
+        # True if the left side of the face is the clear one (see clearLeftSide)
+        return bool(self.anchors.clearLeft[0])
+
+    def box(self, name):
+        # Function to get the (x, y, x2, y2) rectangle of a feature
+        if name not in self._boxes:
+            if name not in FEATURE_BOXES:
+                raise KeyError(name)
+            self._boxes[name] = tuple(int(self.anchors[anchor][0]) for anchor in FEATURE_BOXES[name])
+        return self._boxes[name]
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        return self.view(name)
+
+    def view(self, name):
+        # Function to get the feature image as a view of the image (any feature, requested or not)
+        if name not in self._views:
+            x, y, x2, y2 = self.box(name)
+            self._views[name] = self.image[y:y2, x:x2]
+        return self._views[name]
+
+    def toDict(self):
+        # Function to get the requested features as a dictionary (same output as face_parts_imgs)
+        return {name: self[name] for name in self.names}
+
+
+def face_parts_crops(image, landmarks_points, options):
+   # Facial feature extraction without copying pixels
+   # Input: same as face_parts_imgs
+   # Output: FeatureCrops (rectangles of the features + reference to the image)
+    with getProfiler().stage('crop'):
+        names = resolveFeatureNames(options)
+        return FeatureCrops(image, names, featureBoxes(landmarks_points, names))
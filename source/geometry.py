@@ -125,4 +125,108 @@ def sum_slopes(points, absolute=False):
         if _slope == "inf":
             continue
         result += _slope
-    return round(result,3)
\ No newline at end of file
+    return round(result,3)
+
+
+def transformPoints(points, matrix):
+    # Function to apply an affine transformation (2x3 matrix, as returned by cv2) to points of shape (..., 2)
+    points = np.asarray(points, dtype=np.float64)
+    matrix = np.asarray(matrix, dtype=np.float64)
+    return points @ matrix[:, :2].T + matrix[:, 2]
+
+def invertAffine(matrix):
+    # Function to invert an affine transformation (2x3 matrix), e.g. to map aligned points back to the original image
+    matrix = np.asarray(matrix, dtype=np.float64)
+    inverse = np.linalg.inv(np.vstack((matrix, [0, 0, 1])))
+    return inverse[:2]
+
+def transformBoxes(boxes, matrix):
+    # Function to apply an affine transformation to (x, y, x2, y2) boxes of shape (..., 4)
+    # Output: bounding boxes (int) of the transformed corners
+    boxes = np.asarray(boxes, dtype=np.float64)
+    corners = np.stack((boxes[..., [0, 1]], boxes[..., [2, 1]], boxes[..., [0, 3]], boxes[..., [2, 3]]), axis=-2)
+    corners = transformPoints(corners, matrix)
+    return np.concatenate((np.floor(corners.min(axis=-2)), np.ceil(corners.max(axis=-2))), axis=-1).astype(int)
+
+
+# Batched kernels: points of shape (n_faces, n_points, 2) (any leading dimensions), vertical slopes are inf
+
+def slope_batch(points, absolute=False):
+    # Function to calculate the slopes between each point & the next one, output shape (..., n_points-1)
+    points = np.asarray(points, dtype=np.float64)
+    deltas = np.diff(points, axis=-2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = deltas[..., 1] / deltas[..., 0]
+    slopes = np.where(deltas[..., 0] == 0, np.inf, slopes)
+    if absolute:
+        slopes = np.abs(slopes)
+    return np.round(slopes, 3)
+
+def sum_slopes_batch(points, absolute=False):
+    # Function to calculate the sum of slopes of groups of points (vertical slopes are skipped)
+    slopes = slope_batch(points, absolute)
+    return np.round(np.where(np.isfinite(slopes), slopes, 0).sum(axis=-1), 3)
+
+def sum_difference_batch(points):
+    # Function to calculate the gradient difference in Y-axis for groups of points
+    points = np.asarray(points, dtype=np.float64)
+    return np.round(np.round(-np.diff(points[..., 1], axis=-1), 3).sum(axis=-1), 3)
+
+def shape_area_batch(points, circularArray=False):
+    # Function to calculate areas of shapes given their points coordinates (shoelace formula)
+    # Circular array means that first point is added to the end of the array
+    points = np.asarray(points, dtype=np.float64)
+    x, y = points[..., 0], points[..., 1]
+    if circularArray:
+        x1, y1, x2, y2 = x[..., :-1], y[..., :-1], x[..., 1:], y[..., 1:]
+    else:
+        x1, y1, x2, y2 = x, y, np.roll(x, -1, axis=-1), np.roll(y, -1, axis=-1)
+    return np.abs((x1 * y2 - y1 * x2).sum(axis=-1) / 2)
+
+def eyeCenter_batch(points):
+    # Function to calculate the coordinates of the centers of eyes (4 points each), output shape (..., 2)
+    return np.mean(np.asarray(points, dtype=np.float64)[..., :4, :], axis=-2)
+
+def angle_of_3points_batch(p1, p2, p3):
+    # Function to get the angles of three points (p1 is the middle point), points of shape (..., 2)
+    p1, p2, p3 = (np.asarray(p, dtype=np.float64) for p in (p1, p2, p3))
+    radian = np.arctan2(p3[..., 1] - p1[..., 1], p3[..., 0] - p1[..., 0]) - np.arctan2(p2[..., 1] - p1[..., 1], p2[..., 0] - p1[..., 0])
+    return np.degrees(np.abs(radian))
+
+def _replaceUndefined(values, replacement, zero=True):
+    # Function to replace inf (& zero) values, the same way the eyebrow equations handle "inf" slopes
+    undefined = ~np.isfinite(values)
+    if zero:
+        undefined |= values == 0
+    return np.where(undefined, replacement, values)
+
+def equation1_batch(points):
+    # Eyebrows shape detector (equation1) for eyebrows of shape (n_faces, 5, 2)
+    points = np.asarray(points, dtype=np.float64)
+    avgPoint = points[..., [2, 3], :].mean(axis=-2)
+    return angle_of_3points_batch(avgPoint, points[..., 1, :], points[..., 4, :])
+
+def equation2_batch(points):
+    # Eyebrows shape detector (equation2) for eyebrows of shape (n_faces, 5, 2)
+    return _replaceUndefined(slope_batch(np.asarray(points)[..., 3:5, :])[..., 0], 1)
+
+def equation3_batch(points):
+    # Eyebrows shape detector (equation3) for eyebrows of shape (n_faces, 5, 2)
+    slopes = slope_batch(points, True)
+    result = _replaceUndefined(slopes[..., 1], 0, False) + _replaceUndefined(slopes[..., 3], 0, False)
+    return np.where(result == 0, 1, result)
+
+def equation4_batch(points):
+    # Eyebrows shape detector (equation4) for eyebrows of shape (n_faces, 5, 2)
+    points = np.asarray(points, dtype=np.float64)
+    total = np.diff(points[..., :-1, 1], axis=-1)
+    differences = np.abs(total[..., 1] - total[..., 0]) + np.abs(total[..., 2] - total[..., 1])
+    
+    absoluteSlopes = slope_batch(points, True)
+    slope0 = _replaceUndefined(absoluteSlopes[..., 0], 1)
+    slope1 = _replaceUndefined(slope_batch(points[..., 2:4, :])[..., 0], 1)
+    slope2 = absoluteSlopes[..., 3]
+    differences = np.where(differences == 0, 1, differences)
+    
+    result = slope2 * (0.5*slope1/slope0) * (5/differences)
+    return np.where(result == 0, 1, result)
@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import sys
+import cv2
+import numpy as np
+from models import DEFAULT_PREDICTOR68_PATH, DEFAULT_PREDICTOR81_PATH, configureModels
+from detection import facial_landmarks, align_face, pyramidScales, reductionForFaceSize
+from extractor import FEATURE_NAMES, featureBoxes
+from geometry import transformPoints, invertAffine
+from pipeline import FacePipeline
+from io_pipeline import iterImagePaths
+from tiers import TIER_NAMES, tierPipelineOptions
+
+
+# Allowed distance between a point & its golden location, relative to the golden face width (jaw points 0-16)
+# Forehead points (68-80) come from the 81 predictor & the enhancement heuristics: they get a looser tolerance
+DEFAULT_POINT_TOLERANCES = np.where(np.arange(81) < 68, 0.01, 0.02)
+# Allowed distance of each box side, relative to the golden face width
+DEFAULT_BOX_TOLERANCE = 0.02
+
+
+def referenceLandmarks(path, image, models, landmarkMode='68+81'):
+    # Reference implementation (original flow of main): eye points -> align_face -> 81 landmarks on the aligned image
+    # Output: (81 landmarks in the aligned image, matrix mapping image -> aligned image) or None
+    eyePoints = facial_landmarks(image, eyeOnlyMode=True, models=models, landmarkMode=landmarkMode)
+    if eyePoints is None:
+        return None
+    aligned, matrix = align_face(image, eyePoints, returnMatrix=True)
+    landmarks = facial_landmarks(aligned, allowEnhancement=True, models=models, landmarkMode=landmarkMode)
+    if landmarks is None:
+        return None
+    return landmarks, matrix
+
+
+def pipelineMode(**pipelineOptions):
+    # Function to get a mode running FacePipeline (from the decoded image, or from the file if reduced decoding)
+    pipelineOptions.setdefault('allowEnhancement', True)
+
+    def mode(path, image, models):
+        pipeline = FacePipeline(models, **pipelineOptions)
+        result = pipeline.processFile(path) if pipeline.detectionReduction else pipeline.process(image)
+        if result is None:
+            return None
+        return result['landmarks'], result['rotation_matrix']
+    return mode
+
+
+def optimizedModes(minFaceSize=None):
+    # Function to get the optimized modes to check against the goldens: {'name': mode(path, image, models)}
+    # Modes needing the smallest face size (detection pyramid, reduced decoding) are included only if it is given
+    modes = {
+            'pipeline': pipelineMode(),
+            'pipeline_roi': pipelineMode(alignment='roi'),
+            # Accuracy delta of the 81 predictor alone vs the 68+81 merge (per_point_mean_error_px of the summary)
+            'landmarks_81': lambda path, image, models: referenceLandmarks(path, image, models, landmarkMode='81'),
+            'pipeline_81': pipelineMode(landmarkMode='81')
+            }
+    # Accuracy of each quality tier (see tiers.py)
+    for tier in TIER_NAMES:
+        modes['tier_' + tier] = pipelineMode(**tierPipelineOptions(tier, minFaceSize))
+    if minFaceSize:
+        reduction = reductionForFaceSize(minFaceSize)
+        modes['pyramid'] = pipelineMode(detectionScales=pyramidScales(minFaceSize))
+        modes['reduced_decode'] = pipelineMode(detectionReduction=reduction,
+                                               detectionScales=pyramidScales(minFaceSize / reduction))
+    return modes
+
+
+def record_goldens(paths, outputPath, models):
+    # Function to run the reference implementation over a corpus & save its output (npz):
+    #    files (N,), found (N,), landmarks (N, 81, 2), boxes (N, 16, 4) of FEATURE_NAMES, matrices (N, 2, 3)
+    files, found, landmarks, boxes, matrices = [], [], [], [], []
+    for path in paths:
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        reference = referenceLandmarks(path, image, models)
+        files.append(os.path.basename(path))
+        found.append(reference is not None)
+        points, matrix = reference if reference is not None else (np.zeros((81, 2), dtype=int), np.zeros((2, 3)))
+        landmarks.append(points)
+        boxes.append(featureBoxes(points, FEATURE_NAMES))
+        matrices.append(matrix)
+    np.savez_compressed(outputPath, files=np.array(files), found=np.array(found, dtype=bool),
+                        landmarks=np.array(landmarks).reshape(-1, 81, 2),
+                        boxes=np.array(boxes).reshape(-1, len(FEATURE_NAMES), 4),
+                        matrices=np.array(matrices).reshape(-1, 2, 3))
+    return len(files)
+
+
+def load_goldens(path):
+    with np.load(path) as goldens:
+        return {key: goldens[key] for key in goldens.files}
+
+
+def _compose(first, second):
+    # Function to compose 2 affine matrices (2x3): first(second(point))
+    return (np.vstack((first, [0, 0, 1])) @ np.vstack((second, [0, 0, 1])))[:2]
+
+
+def compareFace(points, matrix, goldenPoints, goldenBoxes, goldenMatrix, pointTolerances, boxTolerance):
+    # Function to diff the output of a mode against the golden of one image
+    # Points & boxes corners of the mode are moved from its aligned frame into the aligned frame of the golden
+    # (only a translation when both are aligned with the same angle, e.g. 'roi' alignment)
+    # Output: per point distance (pixels), per box side distance (pixels), face width, failing points & boxes indexes
+    toGolden = _compose(goldenMatrix, invertAffine(matrix))
+    mapped = transformPoints(points, toGolden)
+    boxes = featureBoxes(np.asarray(points), FEATURE_NAMES)
+    boxes = np.round(transformPoints(boxes.reshape(-1, 2, 2), toGolden)).reshape(-1, 4)
+    faceWidth = max(float(np.ptp(goldenPoints[:17, 0])), 1.0)
+    pointErrors = np.linalg.norm(mapped - goldenPoints, axis=1)
+    boxErrors = np.abs(boxes - goldenBoxes)
+    return {
+            'point_errors': pointErrors,
+            'box_errors': boxErrors,
+            'face_width': faceWidth,
+            'failed_points': np.flatnonzero(pointErrors > pointTolerances * faceWidth),
+            'failed_boxes': np.flatnonzero((boxErrors > boxTolerance * faceWidth).any(axis=1))
+            }
+
+
+def check_goldens(folder, goldens, modes, models, pointTolerances=DEFAULT_POINT_TOLERANCES,
+                  boxTolerance=DEFAULT_BOX_TOLERANCE):
+    # Function to run the optimized modes over the corpus & diff them against the goldens
+    # Output: {'mode name': summary} (see summarizeMode)
+    pointTolerances = np.broadcast_to(np.asarray(pointTolerances, dtype=np.float64), (81,))
+    index = {name: i for i, name in enumerate(goldens['files'])}
+    comparisons = {name: [] for name in modes}
+    for path in iterImagePaths(folder):
+        i = index.get(os.path.basename(path))
+        if i is None:
+            continue
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        for name, mode in modes.items():
+            output = mode(path, image, models)
+            if not goldens['found'][i]:
+                comparisons[name].append({'file': goldens['files'][i], 'status': 'extra' if output else 'no_face'})
+                continue
+            if output is None:
+                comparisons[name].append({'file': goldens['files'][i], 'status': 'missed'})
+                continue
+            comparison = compareFace(output[0], output[1], goldens['landmarks'][i], goldens['boxes'][i],
+                                     goldens['matrices'][i], pointTolerances, boxTolerance)
+            comparison.update(file=goldens['files'][i], status='found')
+            comparisons[name].append(comparison)
+    return {name: summarizeMode(results) for name, results in comparisons.items()}
+
+
+def summarizeMode(comparisons):
+    # Function to summarize the diff of a mode: detection agreement, point & box errors, failing images
+    found = [comparison for comparison in comparisons if comparison['status'] == 'found']
+    statuses = [comparison['status'] for comparison in comparisons]
+    failedImages = [comparison['file'] for comparison in found
+                    if len(comparison['failed_points']) or len(comparison['failed_boxes'])]
+    summary = {
+            'images': len(comparisons),
+            'found': len(found),
+            'missed': statuses.count('missed'),
+            'extra': statuses.count('extra'),
+            'failed_images': failedImages,
+            'passed': statuses.count('missed') == 0 and statuses.count('extra') == 0 and not failedImages
+            }
+    if found:
+        pointErrors = np.array([comparison['point_errors'] for comparison in found])
+        relativeErrors = pointErrors / np.array([comparison['face_width'] for comparison in found])[:, np.newaxis]
+        boxErrors = np.array([comparison['box_errors'].max(axis=1) for comparison in found])
+        worstPoints = np.argsort(relativeErrors.max(axis=0))[::-1][:5]
+        summary.update({
+                'mean_point_error_px': float(pointErrors.mean()),
+                'max_point_error_px': float(pointErrors.max()),
+                'mean_relative_error': float(relativeErrors.mean()),
+                'per_point_mean_error_px': [round(float(value), 3) for value in pointErrors.mean(axis=0)],
+                'worst_points': {int(point): float(relativeErrors[:, point].max()) for point in worstPoints},
+                'max_box_error_px': {name: float(boxErrors[:, i].max()) for i, name in enumerate(FEATURE_NAMES)},
+                'failed_points': int(sum(len(comparison['failed_points']) for comparison in found)),
+                'failed_boxes': int(sum(len(comparison['failed_boxes']) for comparison in found))
+                })
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Golden landmarks & boxes of the reference implementation')
+    commands = parser.add_subparsers(dest='command', required=True)
+    record = commands.add_parser('record', help='record the goldens of a corpus with the reference implementation')
+    record.add_argument('folder', help='folder of images')
+    record.add_argument('--output', default='goldens.npz')
+    check = commands.add_parser('check', help='diff the optimized modes against the goldens (exit code 1 on failure)')
+    check.add_argument('folder', help='folder of images (same corpus as the goldens)')
+    check.add_argument('goldens', help='goldens file (npz)')
+    check.add_argument('--modes', nargs='+', default=None, help='modes to check (default: all)')
+    check.add_argument('--min-face-size', type=int, default=None,
+                       help='smallest face width of the corpus (enables the pyramid & reduced decode modes)')
+    check.add_argument('--point-tolerance', type=float, default=None,
+                       help='tolerance of every point, relative to the face width (default: 0.01, forehead 0.02)')
+    check.add_argument('--box-tolerance', type=float, default=DEFAULT_BOX_TOLERANCE)
+    check.add_argument('--json', default=None, help='write the summary report to this file')
+    for command in (record, check):
+        command.add_argument('--predictor68', default=DEFAULT_PREDICTOR68_PATH)
+        command.add_argument('--predictor81', default=DEFAULT_PREDICTOR81_PATH)
+    args = parser.parse_args()
+
+    models = configureModels(args.predictor68, args.predictor81).load()
+    if args.command == 'record':
+        print('recorded', record_goldens(iterImagePaths(args.folder), args.output, models), 'images')
+        return
+
+    modes = optimizedModes(args.min_face_size)
+    if args.modes:
+        unknown = set(args.modes) - set(modes)
+        if unknown:
+            parser.error('unknown modes: %s (available: %s)' % (', '.join(sorted(unknown)), ', '.join(modes)))
+        modes = {name: modes[name] for name in args.modes}
+    tolerances = DEFAULT_POINT_TOLERANCES if args.point_tolerance is None else args.point_tolerance
+    report = check_goldens(args.folder, load_goldens(args.goldens), modes, models, tolerances, args.box_tolerance)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+    for name, summary in report.items():
+        print(name, 'PASSED' if summary['passed'] else 'FAILED',
+              {key: summary[key] for key in ('images', 'found', 'missed', 'extra', 'mean_point_error_px',
+                                             'max_point_error_px', 'failed_points', 'failed_boxes') if key in summary})
+    if not all(summary['passed'] for summary in report.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
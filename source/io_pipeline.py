@@ -0,0 +1,148 @@
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+import cv2
+
+
+# Extensions decoded by the pipeline (other files are skipped without trying to read them)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.jpe', '.png', '.bmp', '.dib', '.tif', '.tiff', '.webp', '.pbm', '.pgm', '.ppm')
+
+
+def iterImagePaths(folder, extensions=IMAGE_EXTENSIONS):
+    # Function to stream images paths of the folder (without listing the whole folder in memory)
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(extensions):
+                yield entry.path
+
+
+# cv2.imread flags decoding a reduced resolution grayscale copy (JPEG is decoded directly at 1/2, 1/4, 1/8 scale)
+REDUCED_GRAYSCALE_FLAGS = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                           4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+def readReducedGrayscale(path, reduction):
+    # Function to decode a reduced resolution grayscale copy of an image (for detection only)
+    return cv2.imread(path, REDUCED_GRAYSCALE_FLAGS[reduction])
+
+
+# Features images formats with encoding parameters (see encodeParameters)
+ENCODE_FORMATS = ('.jpg', '.jpeg', '.png', '.webp')
+
+def encodeParameters(ext='.jpg', quality=95, pngCompression=3):
+    # Function to get the cv2.imwrite parameters of a format
+    if ext.lower() in ('.jpg', '.jpeg'):
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if ext.lower() == '.png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, pngCompression]
+    if ext.lower() == '.webp':
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    return []
+
+
+def writeFeatures(path, features, outputFolder, ext='.jpg', parameters=None):
+    # Function to write the features images of an image into outputFolder/<image file name>/<feature>.<ext>
+    # (file name with its extension: a.jpg & a.png get their own folders)
+    # Output: number of features written (empty crops can't be encoded & are skipped)
+    imageFolder = os.path.join(outputFolder, os.path.basename(path))
+    os.makedirs(imageFolder, exist_ok=True)
+    parameters = encodeParameters(ext) if parameters is None else parameters
+    written = 0
+    for key in features:
+        if features[key].size > 0:
+            cv2.imwrite(os.path.join(imageFolder, key + ext), features[key], parameters)
+            written += 1
+    return written
+
+
+class StagedPipeline:
+    # Decode -> compute -> write pipeline, each stage has its own workers so disk & codecs overlap compute:
+    #    decode: thread pool (cv2.imread releases the GIL)
+    #    compute: any executor (e.g. ProcessPoolExecutor with loaded models), compute(image) -> (status, features, record)
+    #    write: thread pool encoding the features (cv2.imwrite)
+    # The number of images in flight (decoded, computing or writing) is bounded by maxInFlight
+
+    def __init__(self, compute, computeExecutor, outputFolder, decodeWorkers=4, writeWorkers=2, maxInFlight=32,
+                 ext='.jpg', quality=95, pngCompression=3):
+        self.compute = compute
+        self.computeExecutor = computeExecutor
+        self.outputFolder = outputFolder
+        self.decodeWorkers = decodeWorkers
+        self.writeWorkers = writeWorkers
+        self.maxInFlight = maxInFlight
+        self.ext = ext
+        self.parameters = encodeParameters(ext, quality, pngCompression)
+
+    def _finish(self, final, result):
+        final.set_result(result)
+        self._slots.release()
+        if not self._ordered:
+            self._done.put(final)
+
+    def _decoded(self, path, final, future):
+        try:
+            image = future.result()
+        except Exception as error:
+            return self._finish(final, (path, 'error: %s' % error, 0, None))
+        if image is None:
+            return self._finish(final, (path, 'unreadable', 0, None))
+        try:
+            computeFuture = self.computeExecutor.submit(self.compute, image)
+        except Exception as error:
+            return self._finish(final, (path, 'error: %s' % error, 0, None))
+        computeFuture.add_done_callback(partial(self._computed, path, final))
+
+    def _computed(self, path, final, future):
+        try:
+            status, features, record = future.result()
+        except Exception as error:
+            return self._finish(final, (path, 'error: %s' % error, 0, None))
+        if status != 'ok':
+            return self._finish(final, (path, status, 0, record))
+        writeFuture = self._writePool.submit(writeFeatures, path, features, self.outputFolder, self.ext, self.parameters)
+        writeFuture.add_done_callback(partial(self._written, path, final, record))
+
+    def _written(self, path, final, record, future):
+        try:
+            self._finish(final, (path, 'ok', future.result(), record))
+        except Exception as error:
+            self._finish(final, (path, 'error: %s' % error, 0, record))
+
+    def run(self, paths, ordered=True):
+        # Function to process images paths
+        # Output (generator): (path, status, number of features written, record), in input order if ordered
+        os.makedirs(self.outputFolder, exist_ok=True)
+        self._ordered = ordered
+        self._slots = threading.BoundedSemaphore(self.maxInFlight)
+        self._done = queue.Queue()
+        pending = deque()
+        with ThreadPoolExecutor(self.decodeWorkers) as decodePool, ThreadPoolExecutor(self.writeWorkers) as self._writePool:
+            for path in paths:
+                # In order: finished results waiting for a slow head image are bounded too
+                if ordered and len(pending) >= 4 * self.maxInFlight:
+                    yield from self._collect(pending, ordered, block=True)
+                self._slots.acquire()
+                final = Future()
+                pending.append(final)
+                decodePool.submit(cv2.imread, path).add_done_callback(partial(self._decoded, path, final))
+                yield from self._collect(pending, ordered, block=False)
+            while pending:
+                yield from self._collect(pending, ordered, block=True)
+
+    def _collect(self, pending, ordered, block):
+        # Function to yield finished results (in order: only those at the head of pending)
+        if ordered:
+            while pending and (pending[0].done() or block):
+                yield pending.popleft().result()
+                block = False
+        else:
+            while pending:
+                try:
+                    final = self._done.get(block=block)
+                except queue.Empty:
+                    return
+                pending.remove(final)
+                yield final.result()
+                block = False
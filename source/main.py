@@ -1,6 +1,7 @@
 from detection import *
 from geometry import *
 from extractor import *
+from pipeline import FacePipeline
 import cv2
 import os
 
@@ -20,6 +21,10 @@ def main():
 #    cv2.namedWindow(winname)
 #    cv2.moveWindow(winname, 40,30) 
     
+    # Load dlib models once for all images
+    models = getModels().load()
+    pipeline = FacePipeline(models, allowEnhancement=True)
+
     # Capture all images in current folder & their names
     images, filesnames = load_images_from_folder('.')
     
@@ -29,18 +34,16 @@ def main():
 #        cv2.imshow(winname, originalImage) 
 #        cv2.waitKey(0)
         
-        # Detect eyes landmarks, to align the face later
-        eyePoints = facial_landmarks(originalImage, eyeOnlyMode=True)
+        # Detect face once, align it & re-landmark the aligned face
+        result = pipeline.process(originalImage)
         
-        if eyePoints is not None:
-            
-            # Align face and redetect landmarks
-            image = align_face(originalImage, eyePoints)
-            improved_landmarks = facial_landmarks(image, allowEnhancement=True)
+        if result is not None:
+            image = result['aligned_image']
+            improved_landmarks = result['landmarks']
 
             # Extract feature
             options = ['all']
-            feature = face_parts_imgs(originalImage, improved_landmarks, options)
+            feature = face_parts_imgs(image, improved_landmarks, options)
             for key in feature:
                 cv2.imwrite(key + '.jpg', feature[key])
                 cv2.imshow(key, feature[key])
@@ -48,8 +51,6 @@ def main():
             
             # Compare features, cluster & classify -> predict gender, personality, emotions.. whatever
 
-    
-            
-            
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import os
+import time
+import dlib
+from profiling import getProfiler
+
+
+# Default locations of the dlib models (can be overridden by environment variables or configureModels)
+DEFAULT_PREDICTOR68_PATH = os.environ.get('FACIAL_PREDICTOR68_PATH', '../shape_predictor_68_face_landmarks.dat')
+DEFAULT_PREDICTOR81_PATH = os.environ.get('FACIAL_PREDICTOR81_PATH', '../shape_predictor_81_face_landmarks.dat')
+
+
+class FaceModels:
+    # Holder of the dlib face detector & the 68/81 shape predictors
+    # Models are loaded lazily (on first access) and only once, load time of each is kept in loadTimes
+
+    def __init__(self, predictor68Path=DEFAULT_PREDICTOR68_PATH, predictor81Path=DEFAULT_PREDICTOR81_PATH):
+        self.predictor68Path = predictor68Path
+        self.predictor81Path = predictor81Path
+        self.loadTimes = {}
+        self._detector = None
+        self._predictor68 = None
+        self._predictor81 = None
+
+    def _timedLoad(self, name, loader, *args):
+        # Function to load a model & record how long it took (seconds)
+        start = time.perf_counter()
+        with getProfiler().stage('model_load'):
+            model = loader(*args)
+        self.loadTimes[name] = time.perf_counter() - start
+        return model
+
+    @property
+    def detector(self):
+        if self._detector is None:
+            self._detector = self._timedLoad('detector', dlib.get_frontal_face_detector)
+        return self._detector
+
+    @property
+    def predictor68(self):
+        if self._predictor68 is None:
+            self._predictor68 = self._timedLoad('predictor68', dlib.shape_predictor, self.predictor68Path)
+        return self._predictor68
+
+    @property
+    def predictor81(self):
+        if self._predictor81 is None:
+            self._predictor81 = self._timedLoad('predictor81', dlib.shape_predictor, self.predictor81Path)
+        return self._predictor81
+
+    def load(self, names=('detector', 'predictor68', 'predictor81')):
+        # Function to load the models eagerly (e.g. at worker start), so per-image latency is inference only
+        # names: models to load (e.g. detection.requiredModels(landmarkMode)), others stay lazy
+        for name in names:
+            getattr(self, name)
+        return self
+
+    def totalLoadTime(self):
+        return sum(self.loadTimes.values())
+
+
+# Process-wide registry
+_defaultModels = None
+
+def configureModels(predictor68Path=DEFAULT_PREDICTOR68_PATH, predictor81Path=DEFAULT_PREDICTOR81_PATH):
+    # Function to (re)configure the process-wide models, they will be loaded on first use
+    global _defaultModels
+    _defaultModels = FaceModels(predictor68Path, predictor81Path)
+    return _defaultModels
+
+def getModels():
+    # Function to get the process-wide models (created with default paths if not configured)
+    global _defaultModels
+    if _defaultModels is None:
+        _defaultModels = FaceModels()
+    return _defaultModels
@@ -0,0 +1,177 @@
+import cv2
+import dlib
+import numpy as np
+from detection import detectFaces, scaleRectangle, predict68, predict81, predictLandmarks, requiredModels, enhanceLandmarks, alignmentMatrix, alignmentAngle, align_face_roi
+from geometry import transformPoints
+from models import getModels
+from io_pipeline import readReducedGrayscale
+from context import asContext
+from profiling import getProfiler
+
+
+def warpRectangle(rectangle, matrix):
+    # Function to move a dlib rectangle with an affine (rotation) matrix
+    # The center is transformed & the size is kept (after alignment the face is upright, so the box doesn't grow)
+    centerX = (rectangle.left() + rectangle.right()) / 2
+    centerY = (rectangle.top() + rectangle.bottom()) / 2
+    halfWidth = rectangle.width() / 2
+    halfHeight = rectangle.height() / 2
+    centerX, centerY = transformPoints([[centerX, centerY]], matrix)[0]
+    return dlib.rectangle(int(round(centerX - halfWidth)), int(round(centerY - halfHeight)),
+                          int(round(centerX + halfWidth)), int(round(centerY + halfHeight)))
+
+
+def rectangleInside(rectangle, imageShape):
+    # Function to check if a rectangle is completely inside the image
+    return (rectangle.left() >= 0 and rectangle.top() >= 0 and
+            rectangle.right() < imageShape[1] and rectangle.bottom() < imageShape[0])
+
+
+def landmarksError(points, expectedPoints, rectangle):
+    # Function to calculate the mean distance between 2 sets of points, relative to the face rectangle width
+    distances = np.linalg.norm(np.asarray(points, dtype=np.float64) - expectedPoints, axis=1)
+    return np.mean(distances) / max(rectangle.width(), 1)
+
+
+class FacePipeline:
+    # Single pass detect -> align -> re-landmark pipeline
+    # The (expensive) face detector runs once on the original image, the face rectangle & the 68 points are
+    # warped with the alignment rotation matrix & only the shape predictors are re-run on the aligned image.
+    # Full re-detection on the aligned image happens only if the confidence check fails.
+
+    def __init__(self, models=None, allowEnhancement=True, upsample=1, maxLandmarksError=0.05,
+                 alignment='full', roiPadding=0.3, detectionScales=None, detectionReduction=None,
+                 landmarkMode='68+81'):
+        # maxLandmarksError: allowed mean distance (relative to face width) between the re-predicted 68 points
+        #                    & the warped 68 points of the first pass, before falling back to re-detection
+        # alignment: 'full' -> rotate the whole image around its center (align_face)
+        #            'roi'  -> rotate around the eyes & warp only the padded face region (align_face_roi),
+        #                      landmarks are then in ROI coordinates (map back with invertAffine(rotation_matrix))
+        # detectionScales: scale pyramid of the first detection (see detection.pyramidScales)
+        # detectionReduction: processFile decodes a 1/2, 1/4 or 1/8 grayscale copy for detection & decodes the
+        #                     full image only if a face is found (see detection.reductionForFaceSize)
+        # landmarkMode: '68+81' (two shape predictors, higher accuracy) or '81' (81 predictor only, faster)
+        requiredModels(landmarkMode)
+        self.models = models if models is not None else getModels()
+        self.allowEnhancement = allowEnhancement
+        self.upsample = upsample
+        self.maxLandmarksError = maxLandmarksError
+        self.alignment = alignment
+        self.roiPadding = roiPadding
+        self.detectionScales = detectionScales
+        self.detectionReduction = detectionReduction
+        self.landmarkMode = landmarkMode
+        self.stats = {'images': 0, 'faces': 0, 'redetections': 0, 'unreadable': 0}
+
+    def parameters(self):
+        # Function to get the settings that change the output of the pipeline (e.g. for caching)
+        return {
+                'allowEnhancement': self.allowEnhancement,
+                'upsample': self.upsample,
+                'maxLandmarksError': self.maxLandmarksError,
+                'alignment': self.alignment,
+                'roiPadding': self.roiPadding,
+                'detectionScales': list(self.detectionScales) if self.detectionScales else None,
+                'detectionReduction': self.detectionReduction,
+                'landmarkMode': self.landmarkMode
+                }
+
+    def confident(self, points, expectedPoints, rectangle, imageShape):
+        # Function to decide if the warped rectangle can be trusted for the aligned image
+        if not rectangleInside(rectangle, imageShape):
+            return False
+        return landmarksError(points[:68], expectedPoints, rectangle) <= self.maxLandmarksError
+
+    def processFile(self, path):
+        # Function to process an image file, with reduced resolution decoding for detection if configured
+        # Output: same as process (None if the file can't be read)
+        if not self.detectionReduction or self.detectionReduction == 1:
+            image = cv2.imread(path)
+            if image is None:
+                self.stats['unreadable'] += 1
+                return None
+            return self.process(image)
+
+        reduced = readReducedGrayscale(path, self.detectionReduction)
+        if reduced is None:
+            self.stats['unreadable'] += 1
+            return None
+        rectangles = detectFaces(reduced, self.models, self.upsample, self.detectionScales)
+        del reduced
+        if len(rectangles) == 0:
+            self.stats['images'] += 1
+            return None
+        rectangles = [scaleRectangle(rectangle, self.detectionReduction) for rectangle in rectangles]
+        # Full resolution only for landmarks & crops
+        image = cv2.imread(path)
+        if image is None:
+            self.stats['unreadable'] += 1
+            return None
+        return self.process(image, rectangles)
+
+    def process(self, image, rectangles=None):
+        # Function to detect, align & landmark the (first) face of the image
+        # rectangles: faces already detected (in image coordinates), detection is skipped
+        # Output:
+        #    None if no face is found, else dictionary with:
+        #    'aligned_image', 'landmarks' (81 points in aligned image coordinates),
+        #    'rotation_matrix' (affine matrix mapping original image coordinates -> aligned image coordinates),
+        #    'angle' (alignment rotation, degrees), 'rectangle' (face rectangle in aligned image) & its 'face_box',
+        #    'forehead_clear' (None if enhancement is off), 'redetected' (True if the confidence check failed)
+        # image may be an ImageContext: grayscale, pyramid levels & aligned variants are computed once
+        self.stats['images'] += 1
+        context = asContext(image)
+        image = context.image
+        grayscale_image = context.gray
+        if rectangles is None:
+            rectangles = detectFaces(context, self.models, self.upsample, self.detectionScales)
+        if len(rectangles) == 0:
+            return None
+        rectangle = rectangles[0]
+
+        # Eye points of the first pass -> rotation matrix -> aligned image
+        if self.landmarkMode == '81':
+            points68 = predict81(grayscale_image, rectangle, self.models)[:68]
+        else:
+            points68 = predict68(grayscale_image, rectangle, self.models)
+        if self.alignment == 'roi':
+            faceBox = (rectangle.left(), rectangle.top(), rectangle.right(), rectangle.bottom())
+            alignedContext, rot_mat = align_face_roi(context, points68[[39, 42]], faceBox, self.roiPadding)
+        else:
+            rot_mat = alignmentMatrix(image, points68[[39, 42]])
+            alignedContext = context.warp(rot_mat)
+        aligned = alignedContext.image
+        alignedGray = alignedContext.gray
+
+        # Re-run the predictors only, on the warped rectangle
+        alignedRectangle = warpRectangle(rectangle, rot_mat)
+        expectedPoints = transformPoints(points68, rot_mat)
+        fullFacePoints = None
+        if rectangleInside(alignedRectangle, aligned.shape):
+            fullFacePoints = predictLandmarks(alignedGray, alignedRectangle, self.models, landmarkMode=self.landmarkMode)
+
+        redetected = False
+        if fullFacePoints is None or not self.confident(fullFacePoints, expectedPoints, alignedRectangle, aligned.shape):
+            # Fallback: full detection on the aligned image
+            redetected = True
+            self.stats['redetections'] += 1
+            getProfiler().count('redetections')
+            rectangles = detectFaces(alignedContext, self.models, self.upsample, self.detectionScales)
+            if len(rectangles) == 0:
+                return None
+            alignedRectangle = rectangles[0]
+            fullFacePoints = predictLandmarks(alignedGray, alignedRectangle, self.models, landmarkMode=self.landmarkMode)
+
+        fullFacePoints, foreheadClear = enhanceLandmarks(alignedGray, fullFacePoints, self.allowEnhancement, True)
+        self.stats['faces'] += 1
+        getProfiler().count('faces')
+        return {
+                'aligned_image': aligned,
+                'landmarks': fullFacePoints,
+                'rotation_matrix': rot_mat,
+                'angle': alignmentAngle(points68[[39, 42]]),
+                'rectangle': alignedRectangle,
+                'face_box': (alignedRectangle.left(), alignedRectangle.top(), alignedRectangle.right(), alignedRectangle.bottom()),
+                'forehead_clear': foreheadClear,
+                'redetected': redetected
+                }
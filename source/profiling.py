@@ -0,0 +1,188 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+import numpy as np
+
+
+# Pipeline stages reporting into the profiler
+STAGES = ('model_load', 'grayscale', 'detection', 'predictor68', 'predictor81', 'enhancement', 'align', 'crop')
+
+
+class _NullStage:
+    # Stage timer of a disabled profiler (shared, does nothing)
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    # Stage timer: adds the elapsed time of the with block to the profiler
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _Image:
+    # Image scope: stages timed inside the with block are also grouped in a per-image record
+    __slots__ = ('profiler', 'key', 'start')
+
+    def __init__(self, profiler, key):
+        self.profiler = profiler
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.profiler._local.image = {'stages': {}, 'counters': {}}
+        return self
+
+    def __exit__(self, *exception):
+        image = self.profiler._local.image
+        self.profiler._local.image = None
+        image.update(image=self.key, total_ms=(time.perf_counter() - self.start) * 1000)
+        self.profiler.addImage(image)
+        return False
+
+
+class Profiler:
+    # Registry of stages timings & counters
+    #    with profiler.stage('detection'): ...    -> time a stage (aggregated over all calls)
+    #    with profiler.image(path): ...           -> group the stages of one image in a per-image record
+    #    profiler.count('redetections')           -> counters
+    # When disabled, stage() returns a shared no-op timer (one attribute check per call), so hooks stay in place.
+    # Samples are bounded (maxSamples per stage, maxImages per-image records): percentiles are over the latest ones
+
+    def __init__(self, enabled=False, maxSamples=100000, maxImages=10000):
+        self.enabled = enabled
+        self.maxSamples = maxSamples
+        self.maxImages = maxImages
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.samples = defaultdict(lambda: deque(maxlen=self.maxSamples))
+        self.totals = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.images = deque(maxlen=self.maxImages)
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def image(self, key):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Image(self, key)
+
+    def record(self, name, seconds):
+        # Function to add a stage timing (seconds)
+        milliseconds = seconds * 1000
+        with self._lock:
+            self.samples[name].append(milliseconds)
+            self.totals[name] += milliseconds
+            self.calls[name] += 1
+        image = getattr(self._local, 'image', None)
+        if image is not None:
+            image['stages'][name] = image['stages'].get(name, 0.0) + milliseconds
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += value
+            image = getattr(self._local, 'image', None)
+            if image is not None:
+                image['counters'][name] = image['counters'].get(name, 0) + value
+
+    def addImage(self, imageRecord):
+        # Function to add a per-image record (e.g. sent back by a worker process)
+        with self._lock:
+            self.images.append(imageRecord)
+
+    def mergeImage(self, imageRecord):
+        # Function to add a per-image record of another process, with its stages timings (one sample per image)
+        # & counters
+        with self._lock:
+            self.images.append(imageRecord)
+            for name, milliseconds in imageRecord['stages'].items():
+                self.samples[name].append(milliseconds)
+                self.totals[name] += milliseconds
+                self.calls[name] += 1
+            for name, value in imageRecord.get('counters', {}).items():
+                self.counters[name] += value
+
+    def merge(self, report):
+        # Function to add the timings of another profiler report (e.g. of a worker process, see report(raw=True))
+        with self._lock:
+            for name, values in report.get('samples', {}).items():
+                self.samples[name].extend(values)
+                self.totals[name] += sum(values)
+                self.calls[name] += len(values)
+            for name, value in report.get('counters', {}).items():
+                self.counters[name] += value
+            self.images.extend(report.get('images', []))
+
+    def summary(self):
+        # Function to get the aggregate timings of each stage (milliseconds)
+        with self._lock:
+            samples = {name: np.array(values) for name, values in self.samples.items() if len(values)}
+            totals, calls = dict(self.totals), dict(self.calls)
+            images = [image['total_ms'] for image in self.images]
+        summary = {name: _percentiles(values, calls=calls[name], total_ms=totals[name])
+                   for name, values in samples.items()}
+        if images:
+            summary['image'] = _percentiles(np.array(images), calls=len(images), total_ms=float(np.sum(images)))
+        return summary
+
+    def report(self, perImage=True, raw=False):
+        # Function to get the report: {'stages': summary, 'counters': {...}, 'images': [per-image records]}
+        # raw: also include the samples (to merge reports of many processes)
+        report = {'stages': self.summary(), 'counters': dict(self.counters)}
+        if perImage:
+            report['images'] = list(self.images)
+        if raw:
+            report['samples'] = {name: list(values) for name, values in self.samples.items()}
+        return report
+
+    def save(self, path, perImage=True):
+        # Function to write the report as JSON
+        with open(path, 'w') as file:
+            json.dump(self.report(perImage), file, indent=2)
+
+
+def _percentiles(values, calls, total_ms):
+    # Function to summarize timings (milliseconds)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'calls': int(calls), 'total_ms': float(total_ms), 'mean_ms': float(values.mean()),
+            'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(values.max())}
+
+
+# Process-wide profiler (enabled with the FACIAL_PROFILE=1 environment variable or enableProfiling)
+_profiler = Profiler(enabled=os.environ.get('FACIAL_PROFILE') == '1')
+
+def getProfiler():
+    return _profiler
+
+def enableProfiling(enabled=True):
+    # Function to turn the process-wide profiler on/off (timings already recorded are kept)
+    _profiler.enabled = enabled
+    return _profiler
@@ -0,0 +1,94 @@
+import argparse
+import os
+import time
+import cv2
+import numpy as np
+import pandas as pd
+from detection import facial_landmarks, pyramidScales
+from models import getModels
+from io_pipeline import iterImagePaths
+
+
+def compareDetectionScales(folder, minFaceSize, upsample=1, levels=1, allowEnhancement=False, models=None,
+                           fullResolution=False):
+    # Function to compare downscaled detection against the native resolution detection on a folder of images
+    # (both paths detect with the same upsampling, see pyramidScales for levels & fullResolution)
+    # Output: DataFrame, one row per image (times & landmarks error of the downscaled path vs the native path)
+    models = (models if models is not None else getModels()).load()
+    scales = pyramidScales(minFaceSize, upsample, levels, fullResolution)
+    rows = []
+    for path in iterImagePaths(folder):
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        start = time.perf_counter()
+        reference = facial_landmarks(image, allowEnhancement=allowEnhancement, models=models, upsample=upsample)
+        referenceTime = time.perf_counter() - start
+        start = time.perf_counter()
+        scaled = facial_landmarks(image, allowEnhancement=allowEnhancement, models=models, detectionScales=scales,
+                                  upsample=upsample)
+        scaledTime = time.perf_counter() - start
+
+        row = {'file': os.path.basename(path), 'pixels': image.shape[0] * image.shape[1],
+               'native_ms': referenceTime * 1000, 'scaled_ms': scaledTime * 1000,
+               'mean_error_px': np.nan, 'max_error_px': np.nan, 'relative_error': np.nan}
+        if reference is None and scaled is None:
+            row['status'] = 'no_face'
+        elif reference is None:
+            row['status'] = 'extra'
+        elif scaled is None:
+            row['status'] = 'missed'
+        else:
+            row['status'] = 'found'
+            errors = np.linalg.norm(reference.astype(np.float64) - scaled, axis=1)
+            faceWidth = max(np.ptp(reference[:17, 0]), 1)
+            row.update(mean_error_px=errors.mean(), max_error_px=errors.max(), relative_error=errors.mean() / faceWidth)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def summarize(report):
+    # Function to summarize the accuracy vs speed of the downscaled detection
+    # Speed is also given for images without faces alone (every pyramid level runs for them)
+    found = report[report['status'] == 'found']
+    noFace = report[report['status'] == 'no_face']
+    return {
+            'images': len(report),
+            'found': len(found),
+            'missed': int((report['status'] == 'missed').sum()),
+            'extra': int((report['status'] == 'extra').sum()),
+            'native_ms_mean': float(report['native_ms'].mean()),
+            'scaled_ms_mean': float(report['scaled_ms'].mean()),
+            'speedup': float(report['native_ms'].sum() / max(report['scaled_ms'].sum(), 1e-9)),
+            'no_face': len(noFace),
+            'no_face_native_ms_mean': float(noFace['native_ms'].mean()) if len(noFace) else None,
+            'no_face_scaled_ms_mean': float(noFace['scaled_ms'].mean()) if len(noFace) else None,
+            'no_face_speedup': (float(noFace['native_ms'].sum() / max(noFace['scaled_ms'].sum(), 1e-9))
+                                if len(noFace) else None),
+            'mean_error_px': float(found['mean_error_px'].mean()) if len(found) else None,
+            'p95_error_px': float(found['mean_error_px'].quantile(0.95)) if len(found) else None,
+            'mean_relative_error': float(found['relative_error'].mean()) if len(found) else None
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Accuracy vs speed of downscaled face detection')
+    parser.add_argument('folder', help='folder of images')
+    parser.add_argument('--min-face-size', type=int, required=True, help='smallest face width (pixels) to find')
+    parser.add_argument('--levels', type=int, default=1, help='number of pyramid levels')
+    parser.add_argument('--full-resolution', action='store_true', help='end the pyramid with a native resolution pass')
+    parser.add_argument('--upsample', type=int, default=1, help='detector upsampling (both paths)')
+    parser.add_argument('--enhancement', action='store_true')
+    parser.add_argument('--csv', default=None, help='write the per image report to this file')
+    args = parser.parse_args()
+
+    report = compareDetectionScales(args.folder, args.min_face_size, args.upsample, args.levels,
+                                    allowEnhancement=args.enhancement, fullResolution=args.full_resolution)
+    if args.csv:
+        report.to_csv(args.csv, index=False)
+    print(report.to_string(index=False))
+    print(summarize(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,435 @@
+import argparse
+import base64
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import cv2
+import numpy as np
+from models import configureModels, DEFAULT_PREDICTOR68_PATH, DEFAULT_PREDICTOR81_PATH
+from detection import requiredModels, LANDMARK_MODES
+from pipeline import FacePipeline
+from extractor import FEATURE_NAMES, face_parts_crops
+from io_pipeline import encodeParameters, ENCODE_FORMATS
+from tiers import TieredPipeline, TIER_NAMES
+
+
+# Pipeline of the current worker process (models are loaded once, when the worker starts)
+_serverPipeline = None
+
+def initServerWorker(predictor68Path, predictor81Path, pipelineOptions, tierOptions=None):
+    # Function to load the dlib models once per worker process (pipelineOptions: keyword arguments of FacePipeline)
+    # tierOptions: keyword arguments of TieredPipeline (quality tier / per-image deadline), replace pipelineOptions
+    global _serverPipeline
+    cv2.setNumThreads(1)
+    if tierOptions:
+        models = configureModels(predictor68Path, predictor81Path).load()
+        _serverPipeline = TieredPipeline(models, **tierOptions)
+        return
+    landmarkMode = pipelineOptions.get('landmarkMode', '68+81')
+    models = configureModels(predictor68Path, predictor81Path).load(requiredModels(landmarkMode))
+    _serverPipeline = FacePipeline(models, **pipelineOptions)
+
+
+def serveImage(data, options=('all',), crops=False, ext='.jpg', quality=90, receivedAt=None):
+    # Function to process one encoded image (bytes) in a worker
+    # receivedAt: time.time() when the request arrived (the time spent queued counts in the per-image deadline)
+    # Output: JSON-ready dictionary {'status', 'landmarks', 'rotation_matrix', 'face_box', 'angle',
+    #         'forehead_clear', 'boxes': {'feature_name': [x, y, x2, y2]}, 'crops': {'feature_name': base64}}
+    #         (& the quality 'tier' used, with tiers)
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return {'status': 'unreadable'}
+    if isinstance(_serverPipeline, TieredPipeline):
+        result = _serverPipeline.process(image, elapsed=time.time() - receivedAt if receivedAt else 0.0)
+    else:
+        result = _serverPipeline.process(image)
+    if result is None:
+        return {'status': 'no_face'}
+    features = face_parts_crops(result['aligned_image'], result['landmarks'], options)
+    response = {
+            'status': 'ok',
+            'landmarks': np.asarray(result['landmarks']).tolist(),
+            'rotation_matrix': np.asarray(result['rotation_matrix']).tolist(),
+            'face_box': [int(value) for value in result['face_box']],
+            'angle': float(result['angle']),
+            'forehead_clear': result['forehead_clear'],
+            'boxes': {name: list(box) for name, box in features.toDict().items()}
+            }
+    if 'tier' in result:
+        response['tier'] = result['tier']
+    if crops:
+        encoded = features.encode(ext=ext, params=encodeParameters(ext, quality))
+        response['crops'] = {name: base64.b64encode(value).decode('ascii') for name, value in encoded.items()}
+    return response
+
+
+def serveBatch(requests):
+    # Function to process a batch of requests in a worker (one inter-process round trip for the whole batch)
+    # requests: list of (data, options, crops, ext, quality, receivedAt), output: list of responses (same order)
+    responses = []
+    for request in requests:
+        try:
+            responses.append(serveImage(*request))
+        except Exception as error:
+            responses.append({'status': 'error', 'error': str(error)})
+    return responses
+
+
+class Overloaded(Exception):
+    # Raised when the server can't queue more requests (backpressure -> HTTP 503)
+    pass
+
+
+class RequestBatcher:
+    # Groups incoming requests into batches sent to the worker pool:
+    #    a batch is dispatched when it has batchSize requests or its first request waited maxWait seconds
+    #    at most maxInFlight batches are processed at once (concurrency limit), others wait in the queue
+    #    at most maxQueued requests wait, submit() raises Overloaded beyond that (backpressure)
+
+    def __init__(self, executor, batchSize=4, maxWait=0.005, maxQueued=64, maxInFlight=2):
+        self.executor = executor
+        self.batchSize = batchSize
+        self.maxWait = maxWait
+        self._queue = queue.Queue(maxQueued)
+        self._slots = threading.BoundedSemaphore(maxInFlight)
+        self.stats = {'requests': 0, 'rejected': 0, 'batches': 0, 'inFlight': 0, 'tiers': {}}
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def submit(self, request):
+        # Function to queue a request (see serveBatch), output: Future of its response
+        future = Future()
+        try:
+            self._queue.put_nowait((request, future))
+        except queue.Full:
+            with self._lock:
+                self.stats['rejected'] += 1
+            raise Overloaded('%d requests already queued' % self._queue.maxsize)
+        with self._lock:
+            self.stats['requests'] += 1
+        return future
+
+    def queued(self):
+        return self._queue.qsize()
+
+    def snapshot(self):
+        # Function to get a consistent copy of the stats (with the tiers usage) & the queue size
+        with self._lock:
+            stats = dict(self.stats, tiers=dict(self.stats['tiers']))
+        return dict(stats, queued=self.queued())
+
+    def _dispatch(self):
+        while not self._stopped:
+            try:
+                first = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            items = [first]
+            deadline = time.perf_counter() + self.maxWait
+            while len(items) < self.batchSize:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Concurrency limit: wait for a free slot before sending the batch
+            self._slots.acquire()
+            with self._lock:
+                self.stats['batches'] += 1
+                self.stats['inFlight'] += 1
+            try:
+                batchFuture = self.executor.submit(serveBatch, [request for request, _ in items])
+            except Exception as error:
+                self._release()
+                for _, future in items:
+                    future.set_exception(error)
+                continue
+            batchFuture.add_done_callback(lambda done, items=items: self._deliver(items, done))
+
+    def _release(self):
+        with self._lock:
+            self.stats['inFlight'] -= 1
+        self._slots.release()
+
+    def _deliver(self, items, batchFuture):
+        self._release()
+        try:
+            responses = batchFuture.result()
+        except Exception as error:
+            for _, future in items:
+                future.set_exception(error)
+            return
+        with self._lock:
+            for response in responses:
+                if 'tier' in response:
+                    self.stats['tiers'][response['tier']] = self.stats['tiers'].get(response['tier'], 0) + 1
+        for (_, future), response in zip(items, responses):
+            future.set_result(response)
+
+    def close(self):
+        self._stopped = True
+        self._thread.join()
+
+
+class ExtractionHandler(BaseHTTPRequestHandler):
+    # HTTP API:
+    #    POST /landmarks?options=mouth,nose&crops=1&format=jpg&quality=90   body: encoded image (jpg, png...)
+    #         -> 200 JSON response of serveImage, 503 when overloaded (Retry-After), 413 if the image is too large
+    #    GET /health -> workers & batcher stats
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _reply(self, code, body, headers=()):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            return self._reply(404, {'error': 'not found'})
+        stats = self.server.batcher.snapshot()
+        self._reply(200, {'workers': self.server.workers, 'queued': stats.pop('queued'), 'stats': stats})
+
+    def do_POST(self):
+        receivedAt = time.time()
+        url = urlparse(self.path)
+        if url.path != '/landmarks':
+            return self._reply(404, {'error': 'not found'})
+        length = int(self.headers.get('Content-Length', 0))
+        if length <= 0:
+            return self._reply(400, {'error': 'empty body, send the encoded image'})
+        if length > self.server.maxImageBytes:
+            self.close_connection = True
+            return self._reply(413, {'error': 'image larger than %d bytes' % self.server.maxImageBytes})
+        data = self.rfile.read(length)
+
+        query = parse_qs(url.query)
+        options = query.get('options', ['all'])[0].split(',')
+        unknown = set(options) - set(FEATURE_NAMES) - {'all'}
+        if unknown:
+            return self._reply(400, {'error': 'unknown features: %s' % ', '.join(sorted(unknown))})
+        crops = query.get('crops', ['0'])[0] in ('1', 'true')
+        ext = '.' + query.get('format', ['jpg'])[0].lower()
+        if ext not in ENCODE_FORMATS:
+            return self._reply(400, {'error': 'unknown format: %s (expected one of %s)'
+                                     % (ext[1:], ', '.join(name[1:] for name in ENCODE_FORMATS))})
+        try:
+            quality = int(query.get('quality', ['90'])[0])
+        except ValueError:
+            quality = -1
+        if not 0 <= quality <= 100:
+            return self._reply(400, {'error': 'quality must be an integer between 0 & 100'})
+
+        try:
+            future = self.server.batcher.submit((data, tuple(options), crops, ext, quality, receivedAt))
+        except Overloaded as error:
+            return self._reply(503, {'error': str(error)}, [('Retry-After', '1')])
+        try:
+            response = future.result(timeout=self.server.requestTimeout)
+        except FutureTimeoutError:
+            return self._reply(504, {'error': 'timed out'})
+        except Exception as error:
+            return self._reply(500, {'error': str(error)})
+        self._reply(200, response)
+
+
+class _ServerSettings:
+    # Settings shared by the TCP & Unix socket servers
+    def configure(self, batcher, workers, maxImageBytes, requestTimeout, verbose):
+        self.batcher = batcher
+        self.workers = workers
+        self.maxImageBytes = maxImageBytes
+        self.requestTimeout = requestTimeout
+        self.verbose = verbose
+        return self
+
+
+class ExtractionHTTPServer(_ServerSettings, ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class ExtractionUnixServer(_ServerSettings, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(host='127.0.0.1', port=8080, unixSocket=None, workers=None, batchSize=4, maxWait=0.005, maxQueued=64,
+          maxInFlight=None, maxImageBytes=20 * 1024 * 1024, requestTimeout=30.0,
+          predictor68Path=DEFAULT_PREDICTOR68_PATH, predictor81Path=DEFAULT_PREDICTOR81_PATH, verbose=False,
+          tierOptions=None, **pipelineOptions):
+    # Function to run the extraction server until interrupted (HTTP on host:port, or on a Unix socket)
+    # pipelineOptions: keyword arguments of FacePipeline, models are loaded in every worker before serving
+    # tierOptions: keyword arguments of TieredPipeline (e.g. {'deadline': 0.2}), replace pipelineOptions
+    workers = workers or os.cpu_count() or 1
+    maxInFlight = maxInFlight or workers
+    with ProcessPoolExecutor(workers, initializer=initServerWorker,
+                             initargs=(predictor68Path, predictor81Path, pipelineOptions, tierOptions)) as executor:
+        # Warm up: every worker loads its models before the first request
+        list(executor.map(time.sleep, [0.1] * workers))
+        batcher = RequestBatcher(executor, batchSize, maxWait, maxQueued, maxInFlight)
+        if unixSocket:
+            if os.path.exists(unixSocket):
+                os.remove(unixSocket)
+            server = ExtractionUnixServer(unixSocket, ExtractionHandler)
+            address = unixSocket
+        else:
+            server = ExtractionHTTPServer((host, port), ExtractionHandler)
+            address = 'http://%s:%d' % (host, port)
+        server.configure(batcher, workers, maxImageBytes, requestTimeout, verbose)
+        print('serving on', address, 'with', workers, 'workers')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            batcher.close()
+            if unixSocket and os.path.exists(unixSocket):
+                os.remove(unixSocket)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    # HTTP connection over a Unix socket (client side)
+    def __init__(self, path, timeout=60):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.unixPath = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unixPath)
+
+
+def _connection(url=None, unixSocket=None):
+    if unixSocket:
+        return UnixHTTPConnection(unixSocket)
+    address = urlparse(url)
+    return http.client.HTTPConnection(address.hostname, address.port or 80, timeout=60)
+
+
+def load_test(imagePath, url='http://127.0.0.1:8080', unixSocket=None, concurrency=8, requests=200,
+              options=('all',), crops=False):
+    # Function to send requests (the same image) from concurrent clients & measure the server
+    # Output: {'requests', 'ok', 'rejected' (503), 'errors', 'seconds', 'requests_per_s', 'latency p50/p95/p99 ms'}
+    with open(imagePath, 'rb') as file:
+        data = file.read()
+    path = '/landmarks?options=%s&crops=%d' % (','.join(options), int(crops))
+    counter = iter(range(requests))
+    counterLock = threading.Lock()
+
+    def client():
+        latencies, codes = [], []
+        connection = _connection(url, unixSocket)
+        while True:
+            with counterLock:
+                if next(counter, None) is None:
+                    break
+            start = time.perf_counter()
+            try:
+                connection.request('POST', path, body=data, headers={'Content-Type': 'application/octet-stream'})
+                response = connection.getresponse()
+                response.read()
+                codes.append(response.status)
+            except (OSError, http.client.HTTPException):
+                codes.append(0)
+                connection.close()
+                connection = _connection(url, unixSocket)
+            latencies.append((time.perf_counter() - start) * 1000)
+        connection.close()
+        return latencies, codes
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda _: client(), range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies = np.array([value for result in results for value in result[0]])
+    codes = [code for result in results for code in result[1]]
+    ok = np.array([code == 200 for code in codes])
+    report = {
+            'requests': len(codes),
+            'ok': int(ok.sum()),
+            'rejected': codes.count(503),
+            'errors': len(codes) - int(ok.sum()) - codes.count(503),
+            'seconds': elapsed,
+            'requests_per_s': len(codes) / elapsed if elapsed > 0 else 0.0
+            }
+    if ok.any():
+        p50, p95, p99 = np.percentile(latencies[ok], [50, 95, 99])
+        report.update(latency_p50_ms=float(p50), latency_p95_ms=float(p95), latency_p99_ms=float(p99))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Facial landmarks & features extraction server')
+    commands = parser.add_subparsers(dest='command', required=True)
+    server = commands.add_parser('serve', help='run the server (models stay loaded in a pool of workers)')
+    server.add_argument('--host', default='127.0.0.1')
+    server.add_argument('--port', type=int, default=8080)
+    server.add_argument('--unix', default=None, help='serve on this Unix socket instead of TCP')
+    server.add_argument('--workers', type=int, default=None, help='number of worker processes (default: cpu count)')
+    server.add_argument('--batch-size', type=int, default=4, help='maximum requests sent to a worker at once')
+    server.add_argument('--max-wait-ms', type=float, default=5, help='maximum wait to fill a batch')
+    server.add_argument('--max-queued', type=int, default=64, help='queued requests before answering 503')
+    server.add_argument('--max-in-flight', type=int, default=None, help='batches processed at once (default: workers)')
+    server.add_argument('--no-enhancement', action='store_true', help='disable forehead landmarks enhancement')
+    server.add_argument('--alignment', choices=['full', 'roi'], default='full',
+                        help='with --deadline-ms, the alignment of every tier (results keep the same frame)')
+    server.add_argument('--landmark-mode', choices=LANDMARK_MODES, default='68+81')
+    server.add_argument('--tier', choices=TIER_NAMES, default=None,
+                        help='quality tier (replaces --no-enhancement, --alignment & --landmark-mode)')
+    server.add_argument('--deadline-ms', type=float, default=None,
+                        help='per-image deadline (queue wait included), tiers drop automatically under load')
+    server.add_argument('--min-face-size', type=int, default=None, help='smallest face width, enables tiers pyramids')
+    server.add_argument('--predictor68', default=DEFAULT_PREDICTOR68_PATH)
+    server.add_argument('--predictor81', default=DEFAULT_PREDICTOR81_PATH)
+    server.add_argument('--verbose', action='store_true', help='log every request')
+    client = commands.add_parser('load-test', help='send concurrent requests to a running server')
+    client.add_argument('image', help='image sent with every request')
+    client.add_argument('--url', default='http://127.0.0.1:8080')
+    client.add_argument('--unix', default=None, help='connect to this Unix socket instead of the URL')
+    client.add_argument('--concurrency', type=int, default=8)
+    client.add_argument('--requests', type=int, default=200)
+    client.add_argument('--options', nargs='+', default=['all'])
+    client.add_argument('--crops', action='store_true', help='ask for the encoded crops too')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        tierOptions = None
+        if args.tier or args.deadline_ms:
+            tierOptions = {'tier': args.tier or TIER_NAMES[0], 'minFaceSize': args.min_face_size,
+                           'deadline': args.deadline_ms / 1000 if args.deadline_ms else None,
+                           'alignment': args.alignment if args.deadline_ms else None}
+        serve(args.host, args.port, args.unix, args.workers, args.batch_size, args.max_wait_ms / 1000,
+              args.max_queued, args.max_in_flight, predictor68Path=args.predictor68, predictor81Path=args.predictor81,
+              verbose=args.verbose, tierOptions=tierOptions, allowEnhancement=not args.no_enhancement, alignment=args.alignment,
+              landmarkMode=args.landmark_mode)
+    else:
+        print(json.dumps(load_test(args.image, args.url, args.unix, args.concurrency, args.requests, args.options,
+                                   args.crops), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import argparse
+import time
+import cv2
+import dlib
+import numpy as np
+from detection import toGrayscale, detectFaces, predictLandmarks, enhanceLandmarks, LANDMARK_MODES
+from extractor import face_parts_crops
+from models import getModels
+from pipeline import landmarksError
+
+
+def iterVideoFrames(source):
+    # Function to read frames of a video file or a webcam (source = camera index)
+    capture = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+def shiftRectangle(rectangle, dx, dy):
+    # Function to move a dlib rectangle by (dx, dy) pixels
+    dx, dy = int(round(dx)), int(round(dy))
+    return dlib.rectangle(rectangle.left() + dx, rectangle.top() + dy, rectangle.right() + dx, rectangle.bottom() + dy)
+
+
+class LandmarkTracker:
+    # Streaming landmarks detection: the face detector runs only on keyframes (or when tracking is lost)
+    # In between, the previous face rectangle is propagated to the shape predictors:
+    #    tracking='flow' -> the rectangle follows the optical flow (Lucas-Kanade) of the previous 68 points
+    #    tracking='box'  -> the rectangle is re-centered on the previous landmarks (no optical flow)
+    # Tracking is lost if too few points are tracked or the predicted points drift from the tracked ones
+
+    def __init__(self, models=None, keyframeInterval=15, tracking='flow', allowEnhancement=False,
+                 upsample=1, maxLandmarksError=0.08, minTrackedRatio=0.5, detectionScales=None, landmarkMode='68+81'):
+        self.models = models if models is not None else getModels()
+        self.keyframeInterval = keyframeInterval
+        self.tracking = tracking
+        self.allowEnhancement = allowEnhancement
+        self.upsample = upsample
+        self.maxLandmarksError = maxLandmarksError
+        self.minTrackedRatio = minTrackedRatio
+        self.detectionScales = detectionScales
+        self.landmarkMode = landmarkMode
+        self.stats = {'frames': 0, 'keyframes': 0, 'tracked': 0, 'lost': 0, 'no_face': 0}
+        self.reset()
+
+    def reset(self):
+        # Function to forget the tracked face (next frame is a keyframe)
+        self._previousGray = None
+        self._previousPoints = None
+        self._rectangle = None
+        self._offset = None
+        self._sinceKeyframe = 0
+
+    def _track(self, grayscale_image):
+        # Function to propagate the previous rectangle to the current frame
+        # Output: (rectangle, expected positions of the tracked points, tracked points mask)
+        #         or (None, None, None) if tracking is lost
+        previousPoints = self._previousPoints[:68].astype(np.float32)
+        if self.tracking == 'flow':
+            nextPoints, status, _ = cv2.calcOpticalFlowPyrLK(self._previousGray, grayscale_image,
+                                                             previousPoints.reshape(-1, 1, 2), None)
+            status = status.reshape(-1).astype(bool)
+            if status.mean() < self.minTrackedRatio:
+                return None, None, None
+            nextPoints = nextPoints.reshape(-1, 2)
+            dx, dy = np.median(nextPoints[status] - previousPoints[status], axis=0)
+            return shiftRectangle(self._rectangle, dx, dy), nextPoints[status], status
+        # Box mode: keep the rectangle offset (from the landmarks center) of the keyframe
+        dx, dy = previousPoints.mean(axis=0) + self._offset - self._rectangleCenter()
+        return shiftRectangle(self._rectangle, dx, dy), previousPoints, np.ones(68, dtype=bool)
+
+    def _rectangleCenter(self):
+        return np.array([(self._rectangle.left() + self._rectangle.right()) / 2,
+                         (self._rectangle.top() + self._rectangle.bottom()) / 2])
+
+    def process(self, frame):
+        # Function to get the 81 landmarks of the (first) face of a frame
+        # Output: None if no face, else dictionary {'landmarks', 'rectangle', 'keyframe'}
+        self.stats['frames'] += 1
+        grayscale_image = toGrayscale(frame)
+        fullFacePoints = None
+        keyframe = self._rectangle is None or self._sinceKeyframe >= self.keyframeInterval
+
+        if not keyframe:
+            rectangle, expectedPoints, status = self._track(grayscale_image)
+            if rectangle is not None:
+                fullFacePoints = predictLandmarks(grayscale_image, rectangle, self.models, landmarkMode=self.landmarkMode)
+                if landmarksError(fullFacePoints[:68][status], expectedPoints, rectangle) > self.maxLandmarksError:
+                    fullFacePoints = None
+            if fullFacePoints is None:
+                self.stats['lost'] += 1
+                keyframe = True
+            else:
+                self.stats['tracked'] += 1
+                self._sinceKeyframe += 1
+
+        if keyframe:
+            self.stats['keyframes'] += 1
+            rectangles = detectFaces(grayscale_image, self.models, self.upsample, self.detectionScales)
+            if len(rectangles) == 0:
+                self.stats['no_face'] += 1
+                self.reset()
+                return None
+            rectangle = rectangles[0]
+            fullFacePoints = predictLandmarks(grayscale_image, rectangle, self.models, landmarkMode=self.landmarkMode)
+            self._sinceKeyframe = 0
+            self._rectangle = rectangle
+            self._offset = self._rectangleCenter() - fullFacePoints[:68].mean(axis=0)
+
+        # Keep raw predictions for tracking, enhance a copy
+        self._previousGray = grayscale_image
+        self._previousPoints = fullFacePoints.copy()
+        self._rectangle = rectangle
+        fullFacePoints = enhanceLandmarks(grayscale_image, fullFacePoints, self.allowEnhancement)
+        return {'landmarks': fullFacePoints, 'rectangle': rectangle, 'keyframe': keyframe}
+
+
+def stream_landmarks(frames, tracker=None, options=None):
+    # Function to run the landmarks detection (& optionally features crops) on a stream of frames
+    # Input:
+    #    frames: iterator of images (e.g. iterVideoFrames(path))
+    #    options: features to crop (see face_parts_imgs), None -> landmarks only
+    # Output (generator): (frame, result of LandmarkTracker.process, FeatureCrops or None)
+    tracker = tracker if tracker is not None else LandmarkTracker()
+    for frame in frames:
+        result = tracker.process(frame)
+        crops = None
+        if result is not None and options:
+            crops = face_parts_crops(frame, result['landmarks'], options)
+        yield frame, result, crops
+
+
+def benchmarkStream(frames, tracker=None, options=('all',), warmupFrames=10):
+    # Function to measure the sustained frame rate (frames after the warmup) of stream_landmarks
+    tracker = tracker if tracker is not None else LandmarkTracker()
+    tracker.models.load()
+    latencies = []
+    last = time.perf_counter()
+    for frame, result, crops in stream_landmarks(frames, tracker, options):
+        if crops is not None:
+            # Materialize so the crop cost is counted
+            crops.materialize()
+        now = time.perf_counter()
+        latencies.append(now - last)
+        last = now
+
+    measured = np.array(latencies[warmupFrames:] or latencies)
+    report = {
+            'frames': len(latencies),
+            'sustained_fps': float(len(measured) / measured.sum()) if measured.sum() > 0 else 0.0,
+            'latency_p50_ms': float(np.percentile(measured, 50) * 1000) if len(measured) else 0.0,
+            'latency_p95_ms': float(np.percentile(measured, 95) * 1000) if len(measured) else 0.0,
+            }
+    report.update(tracker.stats)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream facial landmarks of a video file or webcam')
+    parser.add_argument('source', help='video file or camera index')
+    parser.add_argument('--keyframe-interval', type=int, default=15, help='frames between forced detections')
+    parser.add_argument('--tracking', choices=['flow', 'box'], default='flow')
+    parser.add_argument('--enhancement', action='store_true', help='enable forehead landmarks enhancement')
+    parser.add_argument('--landmark-mode', choices=LANDMARK_MODES, default='68+81',
+                        help="'81' runs only the 81 points predictor (faster, less accurate face points)")
+    parser.add_argument('--options', nargs='*', default=['all'], help='features to crop (none -> landmarks only)')
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--benchmark', action='store_true', help='print the sustained FPS report instead of showing frames')
+    args = parser.parse_args()
+
+    frames = iterVideoFrames(args.source)
+    if args.max_frames:
+        frames = (frame for i, frame in zip(range(args.max_frames), frames))
+    tracker = LandmarkTracker(keyframeInterval=args.keyframe_interval, tracking=args.tracking,
+                              allowEnhancement=args.enhancement, landmarkMode=args.landmark_mode)
+
+    if args.benchmark:
+        print(benchmarkStream(frames, tracker, args.options))
+        return
+
+    for frame, result, crops in stream_landmarks(frames, tracker, None):
+        if result is not None:
+            for x, y in result['landmarks']:
+                cv2.circle(frame, (int(x), int(y)), radius=0, color=(255,255,255), thickness=4)
+        cv2.imshow('landmarks', frame)
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            break
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import cv2
+import numpy as np
+from extractor import FEATURE_NAMES
+
+
+# Canonical size (width, height) of each feature in model batches
+DEFAULT_FEATURE_SIZES = {
+        'forehead': (224, 64),
+        'left_eyebrow': (96, 32),
+        'right_eyebrow': (96, 32),
+        'both_eyebrow': (192, 32),
+        'clear_eyebrow': (96, 32),
+        'left_eye': (96, 64),
+        'right_eye': (96, 64),
+        'both_eye': (192, 64),
+        'clear_eye': (96, 64),
+        'left_eye_eyebrow': (96, 96),
+        'right_eye_eyebrow': (96, 96),
+        'both_eye_eyebrow': (192, 96),
+        'clear_eye_eyebrow': (96, 96),
+        'nose': (64, 96),
+        'mouth': (128, 64),
+        'eye_nose_mouth_eyebrow': (160, 160)
+        }
+
+
+class FeatureTensorPacker:
+    # Packs features images into preallocated contiguous (N, H, W, C) uint8 buffers, one per feature
+    # Each crop is resized straight into its slot of the buffer (no per-crop allocation), buffers are
+    # reused for every batch: consume (or copy) a batch before packing the next one
+
+    def __init__(self, batchSize, names=None, sizes=None, channels=3, interpolation=cv2.INTER_AREA):
+        # names: features to pack (default: all), sizes: {'feature_name': (width, height)} overrides
+        self.batchSize = batchSize
+        self.channels = channels
+        self.interpolation = interpolation
+        self.sizes = dict(DEFAULT_FEATURE_SIZES)
+        self.sizes.update(sizes or {})
+        self.names = list(names or FEATURE_NAMES)
+        self.buffers = {name: np.zeros((batchSize, self.sizes[name][1], self.sizes[name][0], channels), dtype=np.uint8)
+                        for name in self.names}
+        # valid[name][i] is False if the feature of sample i was missing or empty (slot is zeros)
+        self.valid = {name: np.zeros(batchSize, dtype=bool) for name in self.names}
+        self.count = 0
+
+    def full(self):
+        return self.count >= self.batchSize
+
+    def _slot(self, name, index):
+        # Function to get the (contiguous) destination of a sample in the buffer of a feature
+        slot = self.buffers[name][index]
+        return slot if self.channels > 1 else slot[:, :, 0]
+
+    def add(self, features):
+        # Function to add the features of one face (dictionary of images, FeatureCrops or FaceFeatures)
+        # Output: True if the batch is full
+        if self.full():
+            raise ValueError('batch is full, call reset() after consuming it')
+        index = self.count
+        for name in self.names:
+            if isinstance(features, dict):
+                crop = features.get(name)
+            else:
+                crop = features.view(name) if name in features else None
+            slot = self._slot(name, index)
+            if crop is None or crop.size == 0:
+                slot[...] = 0
+                self.valid[name][index] = False
+                continue
+            if crop.ndim == 3 and self.channels == 1:
+                crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+            elif crop.ndim == 2 and self.channels == 3:
+                crop = cv2.cvtColor(crop, cv2.COLOR_GRAY2BGR)
+            cv2.resize(crop, self.sizes[name], dst=slot, interpolation=self.interpolation)
+            self.valid[name][index] = True
+        self.count += 1
+        return self.full()
+
+    def batch(self):
+        # Function to get the packed batch: {'feature_name': (count, H, W, C) view}, {'feature_name': valid mask}
+        return ({name: self.buffers[name][:self.count] for name in self.names},
+                {name: self.valid[name][:self.count] for name in self.names})
+
+    def reset(self):
+        # Function to start a new batch (buffers are reused)
+        self.count = 0
+
+
+def pack_batches(featuresIterable, packer):
+    # Function to pack a stream of features dictionaries into batches
+    # Output (generator): packer.batch() each time it is full (& the last partial batch)
+    packer.reset()
+    for features in featuresIterable:
+        if packer.add(features):
+            yield packer.batch()
+            packer.reset()
+    if packer.count > 0:
+        yield packer.batch()
+        packer.reset()
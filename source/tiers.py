@@ -0,0 +1,161 @@
+import time
+import cv2
+from detection import pyramidScales, reductionForFaceSize
+from pipeline import FacePipeline
+from context import asContext
+from models import getModels
+from profiling import getProfiler
+
+
+# Quality tiers, most accurate first:
+#    upsample         -> detector upsampling (0 finds faces >= 80 pixels only, much faster)
+#    pyramidLevels    -> detection pyramid levels (needs the smallest face size, see pyramidScales),
+#                        None = full resolution only
+#    landmarkMode     -> '68+81' (two shape predictors) or '81' (81 predictor only)
+#    allowEnhancement -> forehead landmarks enhancement
+#    alignment        -> 'full' (whole image) or 'roi' (face region only, landmarks in ROI coordinates),
+#                        the same for all tiers with a deadline (see TieredPipeline)
+QUALITY_TIERS = {
+        'best': {'upsample': 1, 'pyramidLevels': None, 'landmarkMode': '68+81', 'allowEnhancement': True,
+                 'alignment': 'full'},
+        'balanced': {'upsample': 1, 'pyramidLevels': 2, 'landmarkMode': '68+81', 'allowEnhancement': True,
+                     'alignment': 'roi'},
+        'fast': {'upsample': 0, 'pyramidLevels': 1, 'landmarkMode': '81', 'allowEnhancement': True,
+                 'alignment': 'roi'},
+        'fastest': {'upsample': 0, 'pyramidLevels': 1, 'landmarkMode': '81', 'allowEnhancement': False,
+                    'alignment': 'roi'}
+        }
+TIER_NAMES = list(QUALITY_TIERS)
+
+
+def tierPipelineOptions(tier, minFaceSize=None, detectionReduction=None):
+    # Function to get the FacePipeline keyword arguments of a tier
+    # minFaceSize: smallest face width (pixels) to find, the detection pyramid of the tier is used only if given
+    # detectionReduction: reduced decoding for detection (see tierReduction), the pyramid is built for the reduced image
+    settings = QUALITY_TIERS[tier]
+    options = {key: settings[key] for key in ('upsample', 'landmarkMode', 'allowEnhancement', 'alignment')}
+    levels = settings['pyramidLevels']
+    reduction = detectionReduction or 1
+    options['detectionScales'] = (pyramidScales(minFaceSize / reduction, settings['upsample'], levels)
+                                  if minFaceSize and levels else None)
+    options['detectionReduction'] = detectionReduction
+    return options
+
+
+def tierReduction(tier, minFaceSize):
+    # Function to get the largest decode reduction that still finds faces of minFaceSize with the upsampling of a tier
+    return reductionForFaceSize(minFaceSize, QUALITY_TIERS[tier]['upsample'])
+
+
+class DeadlineController:
+    # Picks the most accurate tier expected to finish within the remaining time of an image
+    # Cost of each tier is learned online (moving average of milliseconds per megapixel), so tiers drop when
+    # images get slower (load, larger images) & come back when they get faster. A tier without any measure is
+    # tried once, every probeInterval images the tier above the chosen one is re-measured.
+
+    def __init__(self, tiers=TIER_NAMES, safety=0.8, smoothing=0.2, probeInterval=20):
+        self.tiers = list(tiers)
+        self.safety = safety
+        self.smoothing = smoothing
+        self.probeInterval = probeInterval
+        self.costs = {tier: None for tier in self.tiers}
+        self._images = 0
+
+    def predict(self, tier, megapixels):
+        # Function to predict the processing time (milliseconds) of a tier, None if never measured
+        cost = self.costs[tier]
+        return None if cost is None else cost * max(megapixels, 0.01)
+
+    def choose(self, megapixels, remaining):
+        # Function to pick the tier of an image (remaining: seconds left before the deadline)
+        self._images += 1
+        budget = remaining * 1000 * self.safety
+        chosen = self.tiers[-1]
+        for tier in self.tiers:
+            predicted = self.predict(tier, megapixels)
+            if predicted is None or predicted <= budget:
+                chosen = tier
+                break
+        index = self.tiers.index(chosen)
+        if index > 0 and self._images % self.probeInterval == 0:
+            chosen = self.tiers[index - 1]
+        return chosen
+
+    def update(self, tier, milliseconds, megapixels):
+        # Function to learn from the measured processing time of a tier
+        cost = milliseconds / max(megapixels, 0.01)
+        previous = self.costs[tier]
+        self.costs[tier] = cost if previous is None else previous + self.smoothing * (cost - previous)
+
+
+class TieredPipeline:
+    # FacePipeline per quality tier, with a fixed tier or a per-image deadline (adaptive tier)
+    # Results hold the 'tier' used, usage of each tier is kept in stats (see metrics)
+    # With a deadline every tier aligns the same way: landmarks & boxes stay in the same frame ('full' aligned image
+    # or face region) whatever tier the load picks
+
+    def __init__(self, models=None, tier='best', deadline=None, minFaceSize=None, tiers=TIER_NAMES, alignment=None,
+                 **controllerOptions):
+        # tier: tier used without deadline (its alignment is the one of all tiers with a deadline, unless alignment)
+        # deadline: seconds allowed per image (adaptive mode), controllerOptions: see DeadlineController
+        # alignment: 'full' or 'roi' for every tier (default: alignment of each tier, or of tier with a deadline)
+        self.models = models if models is not None else getModels()
+        self.tier = tier
+        self.deadline = deadline
+        self.tiers = list(tiers)
+        if alignment is None and deadline:
+            alignment = QUALITY_TIERS[tier]['alignment']
+        self.alignment = alignment
+        self.pipelines = {}
+        for name in self.tiers:
+            options = tierPipelineOptions(name, minFaceSize)
+            if alignment is not None:
+                options['alignment'] = alignment
+            self.pipelines[name] = FacePipeline(self.models, **options)
+        self.controller = DeadlineController(self.tiers, **controllerOptions) if deadline else None
+        self.stats = {name: {'images': 0, 'faces': 0, 'total_ms': 0.0, 'missed': 0} for name in self.tiers}
+
+    def processFile(self, path, elapsed=0.0):
+        # Function to process an image file (None if it can't be read)
+        image = cv2.imread(path)
+        if image is None:
+            return None
+        return self.process(image, elapsed=elapsed)
+
+    def process(self, image, rectangles=None, elapsed=0.0):
+        # Function to detect, align & landmark the (first) face of the image with the tier of the image
+        # elapsed: seconds already spent on the image before processing (e.g. waiting in a queue)
+        # Output: same as FacePipeline.process, with the 'tier' used
+        context = asContext(image)
+        megapixels = context.shape[0] * context.shape[1] / 1e6
+        if self.controller is None:
+            tier = self.tier
+        else:
+            tier = self.controller.choose(megapixels, self.deadline - elapsed)
+        start = time.perf_counter()
+        result = self.pipelines[tier].process(context, rectangles)
+        milliseconds = (time.perf_counter() - start) * 1000
+        if self.controller is not None:
+            self.controller.update(tier, milliseconds, megapixels)
+
+        stats = self.stats[tier]
+        stats['images'] += 1
+        stats['total_ms'] += milliseconds
+        if self.deadline and elapsed + milliseconds / 1000 > self.deadline:
+            stats['missed'] += 1
+        getProfiler().count('tier.' + tier)
+        if result is None:
+            return None
+        stats['faces'] += 1
+        result['tier'] = tier
+        return result
+
+    def metrics(self):
+        # Function to get the usage of each tier: images, share of all images, mean time, deadline misses
+        total = sum(stats['images'] for stats in self.stats.values())
+        tiers = {}
+        for name, stats in self.stats.items():
+            tiers[name] = dict(stats, share=stats['images'] / total if total else 0.0,
+                               mean_ms=stats['total_ms'] / stats['images'] if stats['images'] else None)
+        return {'images': total, 'deadline_ms': self.deadline * 1000 if self.deadline else None,
+                'missed': sum(stats['missed'] for stats in self.stats.values()), 'tiers': tiers}
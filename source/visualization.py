@@ -0,0 +1,24 @@
+import cv2
+from scipy.spatial import Delaunay
+import matplotlib.pyplot as plt
+from matplotlib import transforms
+
+
+def delaunayOnPlane(facial_points):
+    # Function to visualize delaunay triangulation on matplotlib
+    tri = Delaunay(facial_points)
+    rot = transforms.Affine2D().rotate_deg(180)
+    base = plt.gca().transData
+    plt.gca().invert_xaxis()
+    plt.triplot(facial_points[:,0], facial_points[:,1], tri.simplices.copy(), transform=rot+base)
+    plt.plot(facial_points[:,0], facial_points[:,1], 'o', transform=rot+base)
+    plt.show()
+    
+
+def drawPoints(image, points, pointColor=(255,255,255), lineColor=(255,255,255), pointThickness=6, lineThickness=1):
+    # Function to draw points on facial features
+    for i in points:
+        x,y = i
+        image = cv2.circle(image, (x,y), radius=0, color=pointColor, thickness=pointThickness)
+
+    return image